@@ -35,9 +35,10 @@ setup(
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     update-users-data = presence_analyzer.script:update_users_data
+    generate-data = presence_analyzer.script:generate_data
 
     [paste.app_factory]
-    main = presence_analyzer.script:make_app
+    main = presence_analyzer.script:make_main
     debug = presence_analyzer.script:make_debug
     """,
 )
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of parse, aggregate and serve hot paths.
+
+Each size gets generated presence CSV and users XML files of its own,
+every case is run `repeat` times and its best and mean wall time is
+recorded. Results are written as JSON, which can later serve as baseline
+for `compare`.
+"""
+
+import os
+import sys
+import json
+import shutil
+import platform
+import tempfile
+from datetime import date, datetime
+from itertools import chain
+from multiprocessing import cpu_count
+from timeit import default_timer
+
+from presence_analyzer.main import app
+from presence_analyzer import generator
+from presence_analyzer.dataset import (
+    build_histograms,
+    merge_weekdays,
+    presence_entries,
+)
+from presence_analyzer.utils import (
+    RESPONSE_CACHE,
+    get_data,
+    get_dataset,
+    get_users_data,
+    get_users_directory,
+    get_weekday_start_end,
+    group_by_weekday,
+    load_dataset,
+)
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+SIZES = (15000, 100000, 1000000, 10000000)
+
+# rows of presence data per generated user
+ROWS_PER_USER = 500
+
+VIEWS = (
+    '/api/v1/users',
+    '/api/v1/mean_time_weekday/%(user_id)d',
+    '/api/v1/presence_weekday/%(user_id)d',
+    '/api/v1/presence_start_end/%(user_id)d',
+    '/api/v1/team/mean_time_weekday',
+    '/api/v1/team/presence_weekday',
+    '/api/v1/team/presence_start_end',
+    '/api/v1/presence_stats/%(user_id)d',
+    '/api/v1/team/presence_stats',
+)
+
+
+def write_presence_csv(path, rows, users, seed=0):
+    """
+    Writes about `rows` presence entries of `users` users.
+
+    Entries come from `generator.generate_presence` with users present on
+    every workday from Monday 2011-01-03, so the count is `rows` rounded
+    up to whole days of all users. Returns number of entries written.
+    """
+    days = -(-rows // users)
+    return generator.write_presence_csv(
+        path, users,
+        years=(days // 5 * 7 + days % 5) / 365.25,
+        first_day=date(2011, 1, 3),
+        absence=0,
+        holidays=False,
+        seed=seed,
+    )
+
+
+def timed(function, repeat, setup=None):
+    """
+    Returns (best, mean) wall time of `repeat` calls of function.
+
+    `setup` is called before every call and is not timed.
+    """
+    times = []
+    for i in xrange(repeat):
+        if setup is not None:
+            setup()
+        started = default_timer()
+        function()
+        times.append(default_timer() - started)
+    return min(times), sum(times) / len(times)
+
+
+def _clear_caches():
+    get_dataset.cache.clear()
+    get_users_directory.cache.clear()
+    RESPONSE_CACHE.clear()
+
+
+def _clear_responses():
+    RESPONSE_CACHE.clear()
+    get_dataset().clear_derived()
+
+
+def _merge_weekdays():
+    return merge_weekdays(get_dataset().weekdays.itervalues())
+
+
+def _build_team_histograms():
+    return build_histograms(chain.from_iterable(
+        presence_entries(presence)
+        for presence in get_dataset().users.itervalues()
+    ))
+
+
+def cases(user_id):
+    """
+    Returns (name, function, setup) of benchmarked cases.
+
+    Loading cases start with empty caches, the rest with loaded data
+    but no cached responses nor aggregates the dataset builds on demand.
+    Team aggregates over all users are also timed on their own.
+    """
+    def items():
+        return get_data()[user_id]
+
+    client = app.test_client()
+    result = [
+        ('get_data', get_data, _clear_caches),
+        ('get_users_data', get_users_data, _clear_caches),
+        ('group_by_weekday', lambda: group_by_weekday(items()), None),
+        ('get_weekday_start_end',
+         lambda: get_weekday_start_end(items()), None),
+        ('merge_weekdays', _merge_weekdays, None),
+        ('team build_histograms', _build_team_histograms, None),
+    ]
+    for url in VIEWS:
+        result.append((
+            'view %s' % url.replace('%(user_id)d', '<user_id>'),
+            lambda url=url % {'user_id': user_id}: client.get(url).data,
+            _clear_responses,
+        ))
+    return result
+
+
+def run(sizes=SIZES, repeat=3, seed=0):
+    """
+    Runs all cases for every size, returns results in JSON layout.
+    """
+    results = []
+    temp_dir = tempfile.mkdtemp(prefix='presence-benchmark-')
+    config = dict(app.config)
+    try:
+        for rows in sizes:
+            users = max(1, rows // ROWS_PER_USER)
+            csv_path = os.path.join(temp_dir, 'data-%d.csv' % rows)
+            xml_path = os.path.join(temp_dir, 'users-%d.xml' % rows)
+            log.info('Generating %d rows of %d users', rows, users)
+            write_presence_csv(csv_path, rows, users, seed)
+            generator.write_users_xml(xml_path, users)
+            app.config.update({
+                'DATA_CSV': csv_path,
+                'DATA_PATH': xml_path,
+                'DATA_SNAPSHOT': None,
+            })
+            _clear_caches()
+            get_data()
+            for name, function, setup in cases(user_id=1):
+                best, mean = timed(function, repeat, setup)
+                log.info('%s, %d rows: %.6fs', name, rows, best)
+                results.append({
+                    'name': name,
+                    'rows': rows,
+                    'best': best,
+                    'mean': mean,
+                })
+            os.unlink(csv_path)
+            os.unlink(xml_path)
+    finally:
+        app.config.clear()
+        app.config.update(config)
+        _clear_caches()
+        shutil.rmtree(temp_dir)
+    return make_report(results, repeat)
+
+
+def make_report(results, repeat):
+    """
+    Wraps results with description of the run.
+    """
+    return {
+        'created': datetime.utcnow().isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': cpu_count(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def run_ingestion(rows, workers=(1, 2, 4, 8), repeat=3, seed=0):
+    """
+    Times loading of generated CSV file by growing number of processes.
+
+    Results are in the layout of `run`, each with `speedup` over the
+    first workers count.
+    """
+    temp_dir = tempfile.mkdtemp(prefix='presence-benchmark-')
+    config = dict(app.config)
+    results = []
+    try:
+        csv_path = os.path.join(temp_dir, 'data.csv')
+        write_presence_csv(csv_path, rows, max(1, rows // ROWS_PER_USER),
+                           seed)
+        app.config.update({'DATA_PARALLEL_MIN_BYTES': 0})
+        for count in workers:
+            app.config.update({'DATA_WORKERS': count})
+            best, mean = timed(lambda: load_dataset(csv_path), repeat)
+            log.info('load_dataset by %d workers, %d rows: %.6fs',
+                     count, rows, best)
+            results.append({
+                'name': 'load_dataset workers=%d' % count,
+                'rows': rows,
+                'best': best,
+                'mean': mean,
+                'speedup': results[0]['best'] / best if results else 1.0,
+            })
+    finally:
+        app.config.clear()
+        app.config.update(config)
+        shutil.rmtree(temp_dir)
+    return results
+
+
+def compare(report, baseline, tolerance=0.2):
+    """
+    Compares best times of report with baseline report.
+
+    Returns list of (name, rows, baseline seconds, seconds, ratio,
+    regressed) of cases present in both, a case regressed when it got
+    slower by more than `tolerance` fraction of its baseline time.
+    """
+    previous = {
+        (result['name'], result['rows']): result['best']
+        for result in baseline['results']
+    }
+    comparison = []
+    for result in report['results']:
+        key = (result['name'], result['rows'])
+        if key not in previous:
+            continue
+        ratio = result['best'] / previous[key] if previous[key] else 1.0
+        comparison.append(
+            key + (previous[key], result['best'], ratio,
+                   ratio > 1 + tolerance)
+        )
+    return comparison
+
+
+def save(report, path):
+    """
+    Writes report as JSON.
+    """
+    with open(path, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+
+
+def load(path):
+    """
+    Reads report written by `save`.
+    """
+    with open(path) as report:
+        return json.load(report)
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide caches of values derived from files on disk.
+"""
+
+import os
+import threading
+from functools import wraps
+from collections import OrderedDict
+
+from presence_analyzer.main import app
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+def file_identity(path):
+    """
+    Returns (mtime, size, inode) of given file or None if it can't be stat'ed.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+
+class _Flight(object):
+    """
+    Single in-progress load that concurrent callers can wait for.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class FileCache(object):
+    """
+    Keeps the result of `loader(path)` until the file at `path` changes.
+
+    Entries are keyed by path and validated against the file identity
+    on every access, so a rewritten file is picked up on the next call.
+    Only one thread loads a given path at a time: callers arriving while
+    it runs get the previous version if there is one, otherwise they wait
+    for the load in flight instead of starting their own.
+
+    When `updater` is given, a changed file is first passed to
+    `updater(path, previous_value)`, which may return the new value
+    derived from the previous one, or None to fall back to the loader.
+
+    With `background` set, `get` serves cached entries without checking
+    the file and changes are picked up only by calling `refresh`, which
+    is left to a background thread, see `refresh.Refresher`.
+    """
+
+    def __init__(self, loader, updater=None):
+        self.loader = loader
+        self.updater = updater
+        self.background = False
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.flights = {}
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'reloads': 0,
+            'updates': 0,
+            'waits': 0,
+            'stale': 0,
+        }
+
+    def get(self, path):
+        """
+        Returns cached value for given path, loading it when needed.
+        """
+        if self.background:
+            with self.lock:
+                entry = self.entries.get(path)
+                if entry is not None:
+                    self.stats['hits'] += 1
+                    return entry[1]
+        return self.refresh(path)
+
+    def refresh(self, path):
+        """
+        Returns value for current version of file, loading it when needed.
+        """
+        identity = file_identity(path)
+        if identity is None:
+            # let the loader raise its usual error for a missing file
+            return self.loader(path)
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == identity:
+                self.stats['hits'] += 1
+                return entry[1]
+            flight = self.flights.get(path)
+            if flight is None:
+                flight = self.flights[path] = _Flight()
+                leader = True
+                if entry is None:
+                    self.stats['misses'] += 1
+                else:
+                    self.stats['reloads'] += 1
+            elif entry is not None:
+                self.stats['stale'] += 1
+                return entry[1]
+            else:
+                leader = False
+                self.stats['waits'] += 1
+
+        if leader:
+            previous = entry[1] if entry is not None else None
+            return self._load(path, identity, flight, previous)
+
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def _load(self, path, identity, flight, previous=None):
+        """
+        Runs the loader for given flight and swaps its result in.
+        """
+        try:
+            if previous is not None and self.updater is not None:
+                flight.value = self.updater(path, previous)
+            if flight.value is None:
+                log.debug('Loading %s', path)
+                flight.value = self.loader(path)
+            else:
+                with self.lock:
+                    self.stats['updates'] += 1
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                if flight.error is None:
+                    self.entries[path] = (identity, flight.value)
+                del self.flights[path]
+            flight.done.set()
+        return flight.value
+
+    def version(self, path):
+        """
+        Returns identity of currently cached version of given path.
+        """
+        with self.lock:
+            entry = self.entries.get(path)
+        return entry[0] if entry is not None else None
+
+    def peek(self, path):
+        """
+        Returns currently cached value of given path without loading it.
+        """
+        with self.lock:
+            entry = self.entries.get(path)
+        return entry[1] if entry is not None else None
+
+    def invalidate(self):
+        """
+        Drops all cached entries, so they are loaded again on next access.
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def clear(self):
+        """
+        Drops all cached entries, resets counters and background mode.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.background = False
+            for key in self.stats:
+                self.stats[key] = 0
+
+
+def cached_by_file(config_key, updater=None):
+    """
+    Caches wrapped loader's result for the file named by given config key.
+
+    Wrapped function is called with the file path and gets `cache`
+    attribute holding its `FileCache` and `refresh` function checking
+    the file regardless of background mode.
+    """
+    def decorator(function):
+        cache = FileCache(function, updater)
+
+        @wraps(function)
+        def inner():
+            return cache.get(app.config[config_key])
+        inner.cache = cache
+        inner.refresh = lambda: cache.refresh(app.config[config_key])
+        return inner
+    return decorator
+
+
+class ResponseCache(object):
+    """
+    LRU cache of serialized response bodies, each of its data version.
+
+    Views may be versioned differently, so every body is stored with the
+    version it was made of and a body of another version is dropped when
+    looked up. Total size of cached bodies, including ones not looked up
+    since their version changed, is kept within the byte budget given to
+    `put`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+    def _drop(self, key):
+        """
+        Removes entry of given key, call with lock held.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+        return entry
+
+    def get(self, key, version):
+        """
+        Returns cached body for given key and data version or None.
+        """
+        with self.lock:
+            entry = self._drop(key)
+            if entry is not None and entry[0] != version:
+                self.stats['invalidations'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries[key] = entry
+            self.size += len(entry[1])
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def put(self, key, version, body, max_bytes):
+        """
+        Stores body, evicting least recently used ones over `max_bytes`.
+        """
+        if len(body) > max_bytes:
+            return
+        with self.lock:
+            self._drop(key)
+            self.entries[key] = (version, body)
+            self.size += len(body)
+            while self.size > max_bytes:
+                self.size -= len(self.entries.popitem(last=False)[1][1])
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        """
+        Drops all cached bodies and resets counters.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            for key in self.stats:
+                self.stats[key] = 0
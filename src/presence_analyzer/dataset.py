@@ -0,0 +1,654 @@
+# -*- coding: utf-8 -*-
+"""
+Presence dataset with aggregates precomputed at load time.
+
+Entries are kept in columnar form: for every user three parallel arrays
+of day ordinals, start and end seconds since midnight, sorted by day.
+"""
+
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Mapping
+from datetime import date, time
+from itertools import chain, izip, repeat
+
+
+def _time(seconds):
+    """
+    Converts seconds since midnight to datetime.time.
+    """
+    hour, seconds = divmod(seconds, 3600)
+    minute, second = divmod(seconds, 60)
+    return time(hour, minute, second)
+
+
+def weekday(day):
+    """
+    Returns weekday of given day ordinal, Monday is 0.
+    """
+    return (day - 1) % 7
+
+
+class UserPresence(object):
+    """
+    Presence entries of one user stored in day-sorted parallel arrays.
+    """
+    __slots__ = ('days', 'starts', 'ends', 'ordered')
+
+    def __init__(self):
+        self.days = array('i')
+        self.starts = array('i')
+        self.ends = array('i')
+        self.ordered = True
+
+    def __len__(self):
+        return len(self.days)
+
+    def copy(self):
+        """
+        Returns independent copy of entries.
+        """
+        presence = UserPresence()
+        presence.days = array('i', self.days)
+        presence.starts = array('i', self.starts)
+        presence.ends = array('i', self.ends)
+        presence.ordered = self.ordered
+        return presence
+
+    def append(self, day, start, end):
+        """
+        Adds entry, call `finalize` once all entries are added.
+        """
+        if self.days and self.days[-1] >= day:
+            self.ordered = False
+        self.days.append(day)
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def extend(self, presence):
+        """
+        Adds entries of another `UserPresence` after own ones.
+        """
+        if presence.days and (not presence.ordered or self.days and
+                              self.days[-1] >= presence.days[0]):
+            self.ordered = False
+        self.days.extend(presence.days)
+        self.starts.extend(presence.starts)
+        self.ends.extend(presence.ends)
+
+    def finalize(self):
+        """
+        Sorts entries by day. Last entry of a day wins, like in CSV file.
+        """
+        if self.ordered:
+            return
+        last = {}
+        for i, day in enumerate(self.days):
+            last[day] = i
+        days = sorted(last)
+        order = [last[day] for day in days]
+        self.days = array('i', days)
+        self.starts = array('i', (self.starts[i] for i in order))
+        self.ends = array('i', (self.ends[i] for i in order))
+        self.ordered = True
+
+    def bounds(self, first_day, last_day):
+        """
+        Returns (low, high) index range of entries between given days.
+        """
+        return (bisect_left(self.days, first_day),
+                bisect_right(self.days, last_day))
+
+    def find(self, day):
+        """
+        Returns index of entry for given day ordinal or -1.
+        """
+        i = bisect_left(self.days, day)
+        if i < len(self.days) and self.days[i] == day:
+            return i
+        return -1
+
+
+class PresenceItems(Mapping):
+    """
+    Read-only view of `UserPresence` in the dict layout of `get_data`.
+
+    Maps datetime.date to {'start': datetime.time, 'end': datetime.time}.
+    """
+
+    def __init__(self, presence):
+        self.presence = presence
+
+    def __getitem__(self, key):
+        i = self.presence.find(key.toordinal())
+        if i < 0:
+            raise KeyError(key)
+        return {
+            'start': _time(self.presence.starts[i]),
+            'end': _time(self.presence.ends[i]),
+        }
+
+    def __iter__(self):
+        return (date.fromordinal(day) for day in self.presence.days)
+
+    def __len__(self):
+        return len(self.presence)
+
+
+class WeekdayAggregate(object):
+    """
+    Running sums of presence entries falling on one weekday.
+    """
+    __slots__ = ('count', 'total', 'start', 'end')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.start = 0
+        self.end = 0
+
+    def copy(self):
+        """
+        Returns independent copy of sums.
+        """
+        aggregate = WeekdayAggregate()
+        aggregate.count = self.count
+        aggregate.total = self.total
+        aggregate.start = self.start
+        aggregate.end = self.end
+        return aggregate
+
+    def add(self, start, end):
+        """
+        Adds entry given as start and end seconds since midnight.
+        """
+        self.count += 1
+        self.total += end - start
+        self.start += start
+        self.end += end
+
+
+# histograms count entries in bins of this many seconds of a day, values
+# outside of a day fall into the first or last bin
+BIN_SECONDS = 300
+BINS = 24 * 3600 // BIN_SECONDS
+
+# histograms kept for every weekday
+HISTOGRAM_KINDS = ('arrival', 'departure', 'duration')
+
+
+def _bin(seconds):
+    """
+    Returns histogram bin of given seconds.
+    """
+    return min(max(seconds // BIN_SECONDS, 0), BINS - 1)
+
+
+class BinCounts(object):
+    """
+    Counts of values in BINS fixed bins.
+
+    Only bins from the first to the last non-empty one are stored, which
+    for times of day of one user is a few hours out of 24, in unsigned
+    shorts unless a count doesn't fit.
+    """
+    __slots__ = ('first', 'counts')
+
+    def __init__(self, counts=()):
+        used = [i for i, count in enumerate(counts) if count]
+        self.first = used[0] if used else 0
+        counts = counts[self.first:used[-1] + 1] if used else ()
+        self.counts = array('H' if max(counts or [0]) <= 0xFFFF else 'I',
+                            counts)
+
+    def __len__(self):
+        return BINS
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += BINS
+        if not 0 <= i < BINS:
+            raise IndexError(i)
+        i -= self.first
+        return self.counts[i] if 0 <= i < len(self.counts) else 0
+
+    def __iter__(self):
+        return chain(repeat(0, self.first), self.counts,
+                     repeat(0, BINS - self.first - len(self.counts)))
+
+    def total(self):
+        """
+        Returns number of counted values.
+        """
+        return sum(self.counts)
+
+    def quantiles(self, fractions):
+        """
+        Returns values below which given fractions of counted ones fall.
+
+        Values are interpolated linearly within bins, so they are off
+        by less than BIN_SECONDS. Returns Nones when nothing is counted.
+        """
+        total = self.total()
+        result = [None] * len(fractions)
+        if not total:
+            return result
+        # (rank, position) of pending fractions, smallest rank last
+        pending = sorted(((fraction * total, i)
+                          for i, fraction in enumerate(fractions)),
+                         reverse=True)
+        below = 0
+        for i, count in enumerate(self.counts, self.first):
+            while pending and count and below + count >= pending[-1][0]:
+                rank, position = pending.pop()
+                result[position] = int(round(
+                    (i + (rank - below) / count) * BIN_SECONDS
+                ))
+            below += count
+        return result
+
+
+class WeekdayHistograms(object):
+    """
+    Histograms of arrival, departure and duration on one weekday.
+
+    Each is `BinCounts` built from full list of BINS counts.
+    """
+    __slots__ = HISTOGRAM_KINDS
+
+    def __init__(self, arrival=(), departure=(), duration=()):
+        self.arrival = BinCounts(arrival)
+        self.departure = BinCounts(departure)
+        self.duration = BinCounts(duration)
+
+    @property
+    def count(self):
+        """
+        Number of entries counted.
+        """
+        return self.arrival.total()
+
+    def quantiles(self, kind, fractions):
+        """
+        Returns seconds below which given fractions of entries fall.
+        """
+        return getattr(self, kind).quantiles(fractions)
+
+
+def empty_bins():
+    """
+    Returns zeroed counts of every weekday and histogram kind.
+    """
+    return [[[0] * BINS for kind in HISTOGRAM_KINDS] for i in range(7)]
+
+
+def build_histograms(entries):
+    """
+    Builds seven `WeekdayHistograms` of (day, start, end) entries.
+    """
+    bins = empty_bins()
+    for day, start, end in entries:
+        arrival, departure, duration = bins[weekday(day)]
+        arrival[_bin(start)] += 1
+        departure[_bin(end)] += 1
+        duration[_bin(end - start)] += 1
+    return [WeekdayHistograms(*counts) for counts in bins]
+
+
+def presence_entries(presence):
+    """
+    Returns iterator of (day, start, end) entries of `UserPresence`.
+    """
+    return izip(presence.days, presence.starts, presence.ends)
+
+
+class PeriodIndex(object):
+    """
+    Prefix sums of user's entries split by weekday, for period queries.
+
+    For each weekday it keeps sorted days and running sums of intervals,
+    start and end seconds, so sums over any period take two bisections.
+    """
+    __slots__ = ('days', 'totals', 'starts', 'ends')
+
+    def __init__(self, presence):
+        self.days = [array('i') for i in range(7)]
+        self.totals = [array('l', [0]) for i in range(7)]
+        self.starts = [array('l', [0]) for i in range(7)]
+        self.ends = [array('l', [0]) for i in range(7)]
+        for day, start, end in izip(presence.days,
+                                    presence.starts,
+                                    presence.ends):
+            i = weekday(day)
+            self.days[i].append(day)
+            self.totals[i].append(self.totals[i][-1] + end - start)
+            self.starts[i].append(self.starts[i][-1] + start)
+            self.ends[i].append(self.ends[i][-1] + end)
+
+    def weekdays(self, first_day, last_day):
+        """
+        Returns seven `WeekdayAggregate` of entries between given days.
+        """
+        result = []
+        for i in range(7):
+            low = bisect_left(self.days[i], first_day)
+            high = bisect_right(self.days[i], last_day)
+            aggregate = WeekdayAggregate()
+            if high > low:
+                aggregate.count = high - low
+                aggregate.total = self.totals[i][high] - self.totals[i][low]
+                aggregate.start = self.starts[i][high] - self.starts[i][low]
+                aggregate.end = self.ends[i][high] - self.ends[i][low]
+            result.append(aggregate)
+        return result
+
+
+def build_weekday_index(users):
+    """
+    Builds per-user list of seven `WeekdayAggregate`, Monday first.
+    """
+    index = {}
+    for user_id, presence in users.iteritems():
+        weekdays = [WeekdayAggregate() for i in range(7)]
+        for day, start, end in izip(presence.days,
+                                    presence.starts,
+                                    presence.ends):
+            weekdays[weekday(day)].add(start, end)
+        index[user_id] = weekdays
+    return index
+
+
+class Dataset(object):
+    """
+    Single version of presence data together with its aggregates.
+    """
+
+    def __init__(self, users, weekdays=None, source=None):
+        self.users = users
+        if weekdays is None:
+            weekdays = build_weekday_index(users)
+        self.weekdays = weekdays
+        # how far the data file was read, see `parsers.read_source`
+        self.source = source
+        self._team_weekdays = None
+        self._team_histograms = None
+        self._periods = {}
+        # weekday histograms of users, built when first asked for
+        self._histograms = {}
+        # same data in the dict layout of `utils.read_data`
+        self.data = {
+            user_id: PresenceItems(presence)
+            for user_id, presence in users.iteritems()
+        }
+
+    @classmethod
+    def from_entries(cls, entries, source=None):
+        """
+        Builds dataset from (user_id, day, start, end) tuples.
+        """
+        users = {}
+        for user_id, day, start, end in entries:
+            presence = users.get(user_id)
+            if presence is None:
+                presence = users[user_id] = UserPresence()
+            presence.append(day, start, end)
+        for presence in users.itervalues():
+            presence.finalize()
+        return cls(users, source=source)
+
+    def extended(self, entries, source=None):
+        """
+        Returns new dataset with given entries added to this one.
+
+        Only users with new entries are copied, the rest is shared with
+        this dataset, which stays untouched for its current readers.
+        Weekday aggregates are advanced by the new entries when they
+        all come after user's last day, otherwise rebuilt for the user.
+        Histograms built for users without new entries are kept.
+        """
+        users = dict(self.users)
+        weekdays = dict(self.weekdays)
+        added = {}
+        for user_id, day, start, end in entries:
+            presence = added.get(user_id)
+            if presence is None:
+                if user_id in self.users:
+                    presence = self.users[user_id].copy()
+                    weekdays[user_id] = [aggregate.copy()
+                                         for aggregate in weekdays[user_id]]
+                else:
+                    presence = UserPresence()
+                    weekdays[user_id] = [WeekdayAggregate()
+                                         for i in range(7)]
+                added[user_id] = users[user_id] = presence
+            presence.append(day, start, end)
+
+        for user_id, presence in added.iteritems():
+            if presence.ordered:
+                previous = len(self.users.get(user_id, ()))
+                aggregates = weekdays[user_id]
+                for i in xrange(previous, len(presence)):
+                    aggregates[weekday(presence.days[i])].add(
+                        presence.starts[i],
+                        presence.ends[i],
+                    )
+            else:
+                presence.finalize()
+                weekdays.update(build_weekday_index({user_id: presence}))
+        dataset = Dataset(users, weekdays, source)
+        dataset._histograms = {
+            user_id: histograms
+            for user_id, histograms in self._histograms.iteritems()
+            if user_id not in added
+        }
+        return dataset
+
+    def __contains__(self, user_id):
+        return user_id in self.weekdays
+
+    def build_team_aggregates(self):
+        """
+        Builds team aggregates before first request asks for them.
+
+        Returns (team_weekdays, team_histograms).
+        """
+        return self.team_weekdays, self.team_histograms
+
+    def clear_derived(self):
+        """
+        Drops period indexes, histograms and team aggregates built so far.
+        """
+        self._team_weekdays = None
+        self._team_histograms = None
+        self._periods = {}
+        self._histograms = {}
+
+    def period_weekdays(self, user_id, first_day, last_day):
+        """
+        Returns weekday aggregates of given user limited to a period.
+
+        Both ends are day ordinals and are included in the period.
+        """
+        index = self._periods.get(user_id)
+        if index is None:
+            index = self._periods[user_id] = PeriodIndex(
+                self.users[user_id]
+            )
+        return index.weekdays(first_day, last_day)
+
+    def user_histograms(self, user_id):
+        """
+        Returns seven `WeekdayHistograms` of given user.
+        """
+        histograms = self._histograms.get(user_id)
+        if histograms is None:
+            histograms = self._histograms[user_id] = build_histograms(
+                presence_entries(self.users[user_id])
+            )
+        return histograms
+
+    @property
+    def team_weekdays(self):
+        """
+        Weekday aggregates of all users merged together.
+        """
+        if self._team_weekdays is None:
+            self._team_weekdays = merge_weekdays(self.weekdays.itervalues())
+        return self._team_weekdays
+
+    @property
+    def team_histograms(self):
+        """
+        Weekday histograms of all users counted together.
+        """
+        if self._team_histograms is None:
+            self._team_histograms = build_histograms(chain.from_iterable(
+                presence_entries(presence)
+                for presence in self.users.itervalues()
+            ))
+        return self._team_histograms
+
+
+def merge_weekdays(aggregates):
+    """
+    Sums lists of seven `WeekdayAggregate` into one.
+    """
+    merged = [WeekdayAggregate() for i in range(7)]
+    for weekdays in aggregates:
+        for total, aggregate in izip(merged, weekdays):
+            total.count += aggregate.count
+            total.total += aggregate.total
+            total.start += aggregate.start
+            total.end += aggregate.end
+    return merged
+
+
+def weekday_totals(weekdays):
+    """
+    Returns total presence time by weekday.
+    """
+    return [(weekday, aggregate.total)
+            for weekday, aggregate in enumerate(weekdays)]
+
+
+def weekday_means(weekdays):
+    """
+    Returns mean presence time by weekday.
+
+    Like `utils.mean` it gives zero for weekdays without entries.
+    """
+    return [
+        (weekday, float(aggregate.total) / aggregate.count
+         if aggregate.count else 0)
+        for weekday, aggregate in enumerate(weekdays)
+    ]
+
+
+def weekday_start_end(weekdays):
+    """
+    Returns mean start and end seconds by weekday.
+
+    Same structure as `utils.get_weekday_start_end`, weekdays without
+    entries are left out.
+    """
+    return {
+        weekday: {
+            'start': int(float(aggregate.start) / aggregate.count),
+            'end': int(float(aggregate.end) / aggregate.count),
+        }
+        for weekday, aggregate in enumerate(weekdays)
+        if aggregate.count
+    }
+
+
+def weekday_statistics(histograms):
+    """
+    Returns median, 10th and 90th percentile of histograms by weekday.
+
+    Weekdays without entries are left out, values are seconds.
+    """
+    return {
+        weekday: dict(
+            [('count', weekday_histograms.count)] + [
+                (kind, dict(zip(
+                    ('p10', 'median', 'p90'),
+                    weekday_histograms.quantiles(kind, (0.1, 0.5, 0.9)),
+                )))
+                for kind in HISTOGRAM_KINDS
+            ]
+        )
+        for weekday, weekday_histograms in enumerate(histograms)
+        if weekday_histograms.count
+    }
+
+
+def _dict_layout_size(data):
+    """
+    Returns approximate size in bytes of data in dict layout.
+
+    Objects shared between entries are counted once.
+    """
+    seen = set()
+    size = sys.getsizeof(data)
+    for items in data.itervalues():
+        size += sys.getsizeof(items)
+        for key, item in items.iteritems():
+            size += sys.getsizeof(item)
+            for value in (key, item['start'], item['end']):
+                if id(value) not in seen:
+                    seen.add(id(value))
+                    size += sys.getsizeof(value)
+    return size
+
+
+def _columnar_size(users):
+    """
+    Returns approximate size in bytes of columnar data.
+    """
+    size = sys.getsizeof(users)
+    for presence in users.itervalues():
+        size += sys.getsizeof(presence)
+        size += sum(
+            sys.getsizeof(column)
+            for column in (presence.days, presence.starts, presence.ends)
+        )
+    return size
+
+
+def _histograms_size(dataset):
+    """
+    Returns approximate size in bytes of weekday histograms of all users.
+
+    Histograms not built yet are built for measuring only, so the size
+    is what the dataset takes once every user was asked for.
+    """
+    size = 0
+    for user_id, presence in dataset.users.iteritems():
+        histograms = dataset._histograms.get(user_id)
+        if histograms is None:
+            histograms = build_histograms(presence_entries(presence))
+        size += sys.getsizeof(histograms)
+        for weekday_histograms in histograms:
+            size += sys.getsizeof(weekday_histograms)
+            for kind in HISTOGRAM_KINDS:
+                counts = getattr(weekday_histograms, kind)
+                size += sys.getsizeof(counts) + sys.getsizeof(counts.counts)
+    return size
+
+
+def memory_report(dataset, data):
+    """
+    Compares memory taken by dataset with the same data in dict layout.
+
+    Histograms, which the dict layout has no counterpart of, are given
+    separately.
+    """
+    return {
+        'users': len(dataset.users),
+        'entries': sum(len(presence)
+                       for presence in dataset.users.itervalues()),
+        'columnar_bytes': _columnar_size(dataset.users),
+        'histogram_bytes': _histograms_size(dataset),
+        'dict_bytes': _dict_layout_size(data),
+    }
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Generator of synthetic presence CSV and intranet users XML.
+
+Files are written line by line, so their size is bound only by disk
+space, and the same seed always gives the same output.
+"""
+
+import random
+from datetime import date, timedelta
+from xml.sax.saxutils import escape, quoteattr
+
+from presence_analyzer.parsers import format_seconds
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+# fixed date public holidays as (month, day)
+HOLIDAYS = frozenset([
+    (1, 1), (1, 6), (5, 1), (5, 3), (8, 15),
+    (11, 1), (11, 11), (12, 25), (12, 26),
+])
+
+FIRST_NAMES = (
+    'Adam', 'Agnieszka', 'Anna', 'Bartosz', 'Ewa', 'Jakub', 'Joanna',
+    'Kamil', 'Katarzyna', 'Łukasz', 'Magdalena', 'Marcin', 'Michał',
+    'Monika', 'Paweł', 'Piotr', 'Tomasz', 'Zofia',
+)
+LAST_NAMES = (
+    'Dąbrowski', 'Kamiński', 'Kowalczyk', 'Kowalski', 'Lewandowski',
+    'Nowak', 'Pieśkiewicz', 'Szymański', 'Wiśniewski', 'Wójcik',
+    'Zieliński',
+)
+
+# broken variants of a presence line, like the ones parsers skip
+MALFORMED = (
+    lambda user_id, day, start, end: '%d,%s,%s\n' % (user_id, day, start),
+    lambda user_id, day, start, end: 'x%d,%s,%s,%s\n' % (
+        user_id, day, start, end),
+    lambda user_id, day, start, end: '%d,%s,%s,%s\n' % (
+        user_id, day.replace('-', '/'), start, end),
+    lambda user_id, day, start, end: '%d,%s,25:61:00,%s\n' % (
+        user_id, day, end),
+    lambda user_id, day, start, end: '\n',
+)
+
+
+def parse_clock(value):
+    """
+    Converts H:MM or H:MM:SS string to seconds since midnight.
+    """
+    parts = [int(part) for part in value.split(':')]
+    return sum(part * unit for part, unit in zip(parts, (3600, 60, 1)))
+
+
+def _gauss_seconds(generator, mean, spread):
+    """
+    Returns normally distributed seconds since midnight within the day.
+    """
+    return min(max(int(generator.gauss(mean, spread)), 0), 86399)
+
+
+def workdays(first_day, last_day, holidays=True):
+    """
+    Yields days between given dates without weekends and holidays.
+    """
+    day = first_day
+    while day <= last_day:
+        if day.weekday() < 5 and not (
+                holidays and (day.month, day.day) in HOLIDAYS):
+            yield day
+        day += timedelta(days=1)
+
+
+def generate_presence(output, users, years=1, first_day=date(2011, 1, 3),
+                      arrival=9 * 3600, arrival_spread=45 * 60,
+                      departure=17 * 3600, departure_spread=60 * 60,
+                      absence=0.05, holidays=True, malformed=0.0, seed=0):
+    """
+    Writes presence lines of users numbered from 1 to `output` file.
+
+    Lines go day by day, like entries appended by the presence system.
+    Arrival and departure are normally distributed around given seconds
+    since midnight, shifted by a constant offset drawn for every user.
+    Users are absent on weekends, holidays and on `absence` fraction of
+    other days, `malformed` fraction of lines is broken.
+    Returns number of lines written.
+    """
+    generator = random.Random(seed)
+    offsets = [
+        generator.gauss(0, arrival_spread / 2.0) for i in xrange(users)
+    ]
+    last_day = first_day + timedelta(days=int(round(years * 365.25)) - 1)
+    lines = 0
+    for day in workdays(first_day, last_day, holidays):
+        iso_day = day.isoformat()
+        for user_id, offset in enumerate(offsets, 1):
+            if generator.random() < absence:
+                continue
+            start = _gauss_seconds(generator, arrival + offset,
+                                   arrival_spread)
+            end = _gauss_seconds(generator, departure + offset,
+                                 departure_spread)
+            if end <= start:
+                end = min(start + 3600, 86399)
+            start, end = format_seconds(start), format_seconds(end)
+            if malformed and generator.random() < malformed:
+                line = generator.choice(MALFORMED)(user_id, iso_day,
+                                                   start, end)
+            else:
+                line = '%d,%s,%s,%s\n' % (user_id, iso_day, start, end)
+            output.write(line)
+            lines += 1
+    return lines
+
+
+def generate_users(output, users, host='intranet.example.com', seed=0):
+    """
+    Writes intranet users XML with users numbered from 1 to `output` file.
+    """
+    generator = random.Random(seed)
+    output.write(
+        '<?xml version="1.0" encoding="UTF-8" ?>\n'
+        '<intranet>\n'
+        '    <server>\n'
+        '        <host>%s</host>\n'
+        '        <port>443</port>\n'
+        '        <protocol>https</protocol>\n'
+        '    </server>\n'
+        '    <users>\n' % escape(host)
+    )
+    for user_id in xrange(1, users + 1):
+        name = '%s %s' % (generator.choice(FIRST_NAMES),
+                          generator.choice(LAST_NAMES))
+        output.write(
+            '        <user id=%s>\n'
+            '            <avatar>/api/images/users/%d</avatar>\n'
+            '            <name>%s</name>\n'
+            '        </user>\n' % (quoteattr(str(user_id)), user_id,
+                                   escape(name))
+        )
+    output.write('    </users>\n</intranet>\n')
+
+
+def write_presence_csv(path, users, **options):
+    """
+    Writes presence CSV file, see `generate_presence` for options.
+    """
+    with open(path, 'w') as csvfile:
+        lines = generate_presence(csvfile, users, **options)
+    log.info('%d presence lines written to %s', lines, path)
+    return lines
+
+
+def write_users_xml(path, users, seed=0):
+    """
+    Writes users XML file, see `generate_users`.
+    """
+    with open(path, 'w') as xmlfile:
+        generate_users(xmlfile, users, seed=seed)
+    log.info('%d users written to %s', users, path)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel parsing of presence CSV file in a pool of processes.
+
+The file is split into byte ranges starting and ending at line
+boundaries, every range is parsed by a worker into per-user columns,
+which are then merged in file order. Merged result is the same as of
+parsing the whole file at once: malformed lines are skipped and the
+last row of a user's day wins.
+
+Ranges are split at newlines, so quoted fields spanning lines, which
+presence files never have, are not supported.
+"""
+
+import os
+from multiprocessing import Pool
+
+from presence_analyzer.dataset import UserPresence
+from presence_analyzer.parsers import PARSE_ENGINES
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def byte_ranges(path, parts):
+    """
+    Splits file into at most `parts` (start, end) ranges of whole lines.
+    """
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as csvfile:
+        for i in range(1, parts):
+            position = size * i // parts
+            if position <= offsets[-1]:
+                continue
+            if position >= size:
+                break
+            # the line the position falls into belongs to this range
+            csvfile.seek(position - 1)
+            csvfile.readline()
+            offset = csvfile.tell()
+            if offsets[-1] < offset < size:
+                offsets.append(offset)
+    offsets.append(size)
+    return zip(offsets[:-1], offsets[1:])
+
+
+def range_lines(csvfile, start, end):
+    """
+    Yields lines of file between given offsets, read in large blocks.
+    """
+    csvfile.seek(start)
+    remaining = end - start
+    tail = ''
+    while remaining > 0:
+        data = csvfile.read(min(BLOCK_SIZE, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        lines = (tail + data).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if tail:
+        yield tail
+
+
+def parse_range(args):
+    """
+    Parses one byte range of file in a worker process.
+
+    Returns {user_id: (days, starts, ends)} with columns as strings of
+    finalized `UserPresence` arrays, which are cheap to send back.
+    """
+    path, start, end, engine = args
+    users = {}
+    with open(path, 'rb') as csvfile:
+        entries = PARSE_ENGINES[engine](range_lines(csvfile, start, end))
+        for user_id, day, start_seconds, end_seconds in entries:
+            presence = users.get(user_id)
+            if presence is None:
+                presence = users[user_id] = UserPresence()
+            presence.append(day, start_seconds, end_seconds)
+    result = {}
+    for user_id, presence in users.iteritems():
+        presence.finalize()
+        result[user_id] = (presence.days.tostring(),
+                           presence.starts.tostring(),
+                           presence.ends.tostring())
+    return result
+
+
+def merge_ranges(partials):
+    """
+    Merges results of `parse_range` given in file order into users.
+    """
+    users = {}
+    for partial in partials:
+        for user_id, columns in partial.iteritems():
+            presence = users.get(user_id)
+            if presence is None:
+                presence = users[user_id] = UserPresence()
+            # columns were finalized by the worker
+            part = UserPresence()
+            part.days.fromstring(columns[0])
+            part.starts.fromstring(columns[1])
+            part.ends.fromstring(columns[2])
+            presence.extend(part)
+    for presence in users.itervalues():
+        presence.finalize()
+    return users
+
+
+def parse_parallel(path, engine, workers, parts=None):
+    """
+    Parses file with given parse engine in `workers` processes.
+
+    File is split into `parts` ranges, four per worker by default, so
+    workers finishing early pick up remaining ones.
+    """
+    ranges = byte_ranges(path, parts or workers * 4)
+    log.debug('Parsing %s in %d ranges by %d workers',
+              path, len(ranges), workers)
+    pool = Pool(workers)
+    try:
+        partials = pool.map(
+            parse_range,
+            [(path, start, end, engine) for start, end in ranges],
+            chunksize=1,
+        )
+    finally:
+        pool.terminate()
+        pool.join()
+    return merge_ranges(partials)
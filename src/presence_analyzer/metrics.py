@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Request and phase timings exposed in Prometheus text format.
+
+Nothing is recorded unless METRICS config option is set.
+"""
+
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from timeit import default_timer
+
+from flask import g, has_request_context
+
+from presence_analyzer.main import app
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+# upper bounds in seconds of histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+# load covers reading data files, parse is the part of it spent in
+# parse engines, aggregate is building charts and serialize is JSON
+PHASES = ('load', 'parse', 'aggregate', 'serialize')
+
+
+class Histogram(object):
+    """
+    Counts of observed values in fixed buckets, with their sum.
+    """
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        Adds value to the first bucket it fits in.
+        """
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        """
+        Yields (le, cumulative count) pairs, last one for +Inf.
+        """
+        total = 0
+        for bound, count in zip(BUCKETS + ('+Inf', ), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics(object):
+    """
+    Latency histograms by endpoint and duration histograms by phase.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.phases = {}
+
+    def observe_request(self, endpoint, seconds, phases):
+        """
+        Records request latency and time it spent in each phase.
+        """
+        with self.lock:
+            histogram = self.requests.get(endpoint)
+            if histogram is None:
+                histogram = self.requests[endpoint] = Histogram()
+            histogram.observe(seconds)
+            for name, phase_seconds in phases.iteritems():
+                self._observe_phase(name, phase_seconds)
+
+    def observe_phase(self, name, seconds):
+        """
+        Records time spent in a phase outside of any request.
+        """
+        with self.lock:
+            self._observe_phase(name, seconds)
+
+    def _observe_phase(self, name, seconds):
+        histogram = self.phases.get(name)
+        if histogram is None:
+            histogram = self.phases[name] = Histogram()
+        histogram.observe(seconds)
+
+    def clear(self):
+        """
+        Drops all recorded timings.
+        """
+        with self.lock:
+            self.requests.clear()
+            self.phases.clear()
+
+
+METRICS = Metrics()
+
+
+def enabled():
+    """
+    Checks if timings are recorded, see METRICS config option.
+    """
+    return app.config.get('METRICS', False)
+
+
+@contextmanager
+def phase(name):
+    """
+    Times enclosed block as part of given phase.
+
+    Within a request times of a phase are summed and recorded with the
+    request, otherwise they are recorded right away.
+    """
+    if not enabled():
+        yield
+        return
+    started = default_timer()
+    try:
+        yield
+    finally:
+        seconds = default_timer() - started
+        if has_request_context() and 'metrics_started' in g:
+            g.metrics_phases[name] = g.metrics_phases.get(name, 0) + seconds
+        else:
+            METRICS.observe_phase(name, seconds)
+
+
+def start_request():
+    """
+    Starts timing current request.
+    """
+    if enabled():
+        g.metrics_started = default_timer()
+        g.metrics_phases = {}
+
+
+def finish_request(endpoint):
+    """
+    Records timings of current request.
+    """
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        METRICS.observe_request(
+            endpoint or 'unknown',
+            default_timer() - started,
+            g.pop('metrics_phases'),
+        )
+
+
+def _labels(labels):
+    """
+    Formats labels as {name="value",...}.
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+
+
+def _histogram_lines(name, label, histograms):
+    """
+    Formats histograms keyed by value of given label.
+    """
+    lines = []
+    for key, histogram in sorted(histograms.iteritems()):
+        for bound, count in histogram.samples():
+            lines.append('%s_bucket%s %d' % (
+                name, _labels([(label, key), ('le', bound)]), count,
+            ))
+        lines.append('%s_sum%s %r' % (name, _labels([(label, key)]),
+                                      histogram.sum))
+        lines.append('%s_count%s %d' % (name, _labels([(label, key)]),
+                                        sum(histogram.counts)))
+    return lines
+
+
+def render(gauges=()):
+    """
+    Returns recorded timings and given gauges in Prometheus text format.
+
+    Gauges are (name, type, help, [(labels, value), ...]) tuples,
+    labels being list of (name, value) pairs.
+    """
+    lines = [
+        '# HELP presence_request_duration_seconds Request latency.',
+        '# TYPE presence_request_duration_seconds histogram',
+    ]
+    with METRICS.lock:
+        lines.extend(_histogram_lines(
+            'presence_request_duration_seconds', 'endpoint',
+            METRICS.requests,
+        ))
+        lines.extend([
+            '# HELP presence_phase_duration_seconds '
+            'Time spent in load, parse, aggregate and serialize phases.',
+            '# TYPE presence_phase_duration_seconds histogram',
+        ])
+        lines.extend(_histogram_lines(
+            'presence_phase_duration_seconds', 'phase', METRICS.phases,
+        ))
+    for name, metric_type, help_text, samples in gauges:
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for labels, value in samples:
+            lines.append('%s%s %s' % (name, _labels(labels), value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Parse engines for presence CSV files.
+
+Each engine takes an open file and yields presence entries as tuples
+of (user_id, day ordinal, start seconds, end seconds).
+"""
+
+import os
+import csv
+import zlib
+from collections import namedtuple
+from datetime import datetime, date
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+def _seconds(value):
+    """
+    Calculates amount of seconds since midnight of datetime.time.
+    """
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
+def _strptime_date(value):
+    """
+    Converts YYYY-MM-DD string to day ordinal.
+    """
+    return datetime.strptime(value, '%Y-%m-%d').toordinal()
+
+
+def _strptime_time(value):
+    """
+    Converts HH:MM:SS string to seconds since midnight.
+    """
+    return _seconds(datetime.strptime(value, '%H:%M:%S'))
+
+
+def format_seconds(seconds):
+    """
+    Formats seconds since midnight as HH:MM:SS, like in presence CSV.
+    """
+    hour, seconds = divmod(seconds, 3600)
+    return '%02d:%02d:%02d' % ((hour, ) + divmod(seconds, 60))
+
+
+def parse_csv(csvfile):
+    """
+    Parses rows with csv module and strptime.
+    """
+    presence_reader = csv.reader(csvfile, delimiter=',')
+    for i, row in enumerate(presence_reader):
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+
+        try:
+            user_id = int(row[0])
+            day = _strptime_date(row[1])
+            start = _strptime_time(row[2])
+            end = _strptime_time(row[3])
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+        else:
+            yield user_id, day, start, end
+
+
+def _fast_date(value):
+    """
+    Converts YYYY-MM-DD string to day ordinal without strptime.
+
+    Values not in fixed-width layout are left to strptime, so both
+    engines accept exactly the same input.
+    """
+    if (len(value) == 10 and value[4] == '-' and value[7] == '-' and
+            (value[:4] + value[5:7] + value[8:]).isdigit()):
+        return date(
+            int(value[:4]), int(value[5:7]), int(value[8:])
+        ).toordinal()
+    return _strptime_date(value)
+
+
+def _fast_time(value):
+    """
+    Converts HH:MM:SS string to seconds since midnight without strptime.
+    """
+    if (len(value) == 8 and value[2] == ':' and value[5] == ':' and
+            (value[:2] + value[3:5] + value[6:]).isdigit()):
+        hour, minute, second = int(value[:2]), int(value[3:5]), int(value[6:])
+        if hour < 24 and minute < 60 and second < 60:
+            return hour * 3600 + minute * 60 + second
+    return _strptime_time(value)
+
+
+def parse_fast(csvfile):
+    """
+    Parses rows by slicing fixed-width fields.
+
+    Dates and times repeat a lot in presence files, so their
+    conversions are memoized for the duration of the parse.
+    """
+    days = {}
+    times = {}
+    for i, line in enumerate(csvfile):
+        if '"' in line:
+            row = next(csv.reader([line]), [])
+        else:
+            row = line.rstrip('\r\n').split(',')
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+
+        try:
+            user_id = int(row[0])
+            day = days.get(row[1])
+            if day is None:
+                day = days[row[1]] = _fast_date(row[1])
+            start = times.get(row[2])
+            if start is None:
+                start = times[row[2]] = _fast_time(row[2])
+            end = times.get(row[3])
+            if end is None:
+                end = times[row[3]] = _fast_time(row[3])
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+        else:
+            yield user_id, day, start, end
+
+
+PARSE_ENGINES = {
+    'csv': parse_csv,
+    'fast': parse_fast,
+}
+
+
+SIGNATURE_BLOCK = 4096
+
+# bytes read at once when checksumming file prefix
+CHECKSUM_BLOCK = 1024 * 1024
+
+# Position in a CSV file up to which it was parsed, see `read_source`.
+Source = namedtuple('Source', ['inode', 'offset', 'signature'])
+
+
+def _line_end_offset(csvfile, size):
+    """
+    Returns offset just past the last newline before `size`.
+    """
+    position = size
+    while position > 0:
+        block_start = max(0, position - SIGNATURE_BLOCK)
+        csvfile.seek(block_start)
+        newline = csvfile.read(position - block_start).rfind('\n')
+        if newline >= 0:
+            return block_start + newline + 1
+        position = block_start
+    return 0
+
+
+def _prefix_signature(csvfile, offset):
+    """
+    Returns checksum of file up to `offset`.
+
+    The whole prefix is read, in blocks, so a rewrite of any row is
+    caught. It costs reading the file but not parsing it.
+    """
+    csvfile.seek(0)
+    signature = zlib.crc32('')
+    remaining = offset
+    while remaining > 0:
+        data = csvfile.read(min(CHECKSUM_BLOCK, remaining))
+        if not data:
+            break
+        signature = zlib.crc32(data, signature)
+        remaining -= len(data)
+    return signature
+
+
+def read_source(csvfile):
+    """
+    Describes how far given file can be considered parsed.
+
+    The offset points past the last complete line. A trailing line
+    without newline is parsed again with the next appended rows, which
+    is harmless as the last row of a day wins.
+    """
+    stat = os.fstat(csvfile.fileno())
+    offset = _line_end_offset(csvfile, stat.st_size)
+    return Source(stat.st_ino, offset, _prefix_signature(csvfile, offset))
+
+
+def read_appended(csvfile, source):
+    """
+    Returns (lines, source) of rows appended to file since `source`.
+
+    Returns None when the file was truncated or rewritten in the
+    meantime and has to be parsed in full. Signature of the new source
+    continues the checked one, so the prefix is read only once.
+    """
+    stat = os.fstat(csvfile.fileno())
+    if (stat.st_ino != source.inode or stat.st_size < source.offset or
+            _prefix_signature(csvfile, source.offset) != source.signature):
+        return None
+    csvfile.seek(source.offset)
+    data = csvfile.read(stat.st_size - source.offset)
+    complete = data.rfind('\n') + 1
+    return data.splitlines(True), Source(
+        stat.st_ino,
+        source.offset + complete,
+        zlib.crc32(data[:complete], source.signature),
+    )
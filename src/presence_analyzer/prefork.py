@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-fork WSGI server sharing data loaded once in master process.
+
+Master loads the data, binds the socket and forks workers which inherit
+both, so the columns of loaded dataset stay in pages shared copy-on-write
+between all of them and each worker serves requests on its own core.
+"""
+
+import os
+import time
+import errno
+import signal
+import socket
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+from presence_analyzer.main import app
+from presence_analyzer.cache import file_identity
+from presence_analyzer.refresh import refresh_data
+from presence_analyzer.utils import (
+    get_dataset,
+    get_sqlite_repository,
+    get_users_directory,
+)
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+class QuietHandler(WSGIRequestHandler):
+    """
+    Request handler logging through logging module instead of stderr.
+    """
+
+    def log_message(self, format, *args):  # pylint: disable-msg=W0622
+        log.debug('%s %s', self.client_address[0], format % args)
+
+
+class WorkerServer(WSGIServer):
+    """
+    WSGI server of single worker, accepting on socket bound by master.
+
+    `running` is called before accepting a connection, once it returns
+    False the connection is left for other workers.
+    """
+    timeout = 1
+
+    def __init__(self, listener, app, running):
+        WSGIServer.__init__(self, listener.getsockname(), QuietHandler,
+                            bind_and_activate=False)
+        self.socket.close()
+        self.socket = listener
+        host, port = listener.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(app)
+        self.running = running
+        self.handled = 0
+
+    def get_request(self):
+        if not self.running():
+            raise socket.error(errno.EINTR, 'Worker is stopping')
+        return WSGIServer.get_request(self)
+
+    def process_request(self, request, client_address):
+        WSGIServer.process_request(self, request, client_address)
+        self.handled += 1
+
+    def handle_error(self, request, client_address):
+        log.exception('Problem with request from %s', client_address[0])
+
+
+class PreforkServer(object):
+    """
+    Serves WSGI app from `workers` forked processes.
+
+    `load` is called in master before forking and again whenever
+    `version` returns something new, checked every `check_interval`
+    seconds, or on SIGHUP. Workers are then replaced by ones forked
+    from the reloaded master, old ones finish their current request
+    first. A worker exits after `max_requests` requests (0 for no limit)
+    and is replaced, like paste's threadpool_max_requests.
+    """
+
+    def __init__(self, app, address, workers=4, max_requests=0,
+                 check_interval=30, load=None, version=None):
+        self.app = app
+        self.address = address
+        self.workers = workers
+        self.max_requests = max_requests
+        self.check_interval = check_interval
+        self.load = load or (lambda: None)
+        self.version = version or (lambda: None)
+        self.listener = None
+        self.children = set()
+        self.running = False
+        self.reload_requested = False
+
+    def bind(self):
+        """
+        Creates listening socket, returns its address.
+        """
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(self.address)
+        self.listener.listen(128)
+        return self.listener.getsockname()
+
+    def serve_forever(self):
+        """
+        Runs master loop until SIGTERM or SIGINT.
+        """
+        if self.listener is None:
+            self.bind()
+        self.running = True
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._request_reload)
+
+        self.load()
+        version = self.version()
+        log.info('Serving on %s:%s with %d workers',
+                 self.address[0], self.address[1], self.workers)
+        checked = time.time()
+        while self.running:
+            self._reap()
+            while len(self.children) < self.workers:
+                self._spawn()
+            if time.time() - checked >= self.check_interval:
+                checked = time.time()
+                current = self.version()
+                if current != version:
+                    version = current
+                    self.reload_requested = True
+            if self.reload_requested:
+                self.reload_requested = False
+                self._reload()
+            time.sleep(min(self.check_interval, 1))
+        self._stop_children(self.children)
+        self.listener.close()
+
+    def _reload(self):
+        """
+        Reloads data and replaces all workers with freshly forked ones.
+        """
+        log.info('Reloading data')
+        try:
+            self.load()
+        except Exception:
+            log.exception('Problem with reloading data, keeping workers')
+            return
+        old = set(self.children)
+        self.children.clear()
+        for i in range(self.workers):
+            self._spawn()
+        self._stop_children(old, wait=False)
+
+    def _spawn(self):
+        """
+        Forks new worker.
+        """
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+        status = 0
+        try:
+            self._run_worker()
+        except Exception:
+            log.exception('Worker %d failed', os.getpid())
+            status = 1
+        finally:
+            os._exit(status)  # pylint: disable-msg=W0212
+
+    def _run_worker(self):
+        """
+        Serves requests until asked to stop or `max_requests` are served.
+        """
+        # SIGTERM handler of master is inherited, so `running` is cleared
+        # also when the signal comes before the worker gets here
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        server = WorkerServer(self.listener, self.app, lambda: self.running)
+        while self.running:
+            if self.max_requests and server.handled >= self.max_requests:
+                log.debug('Worker %d recycled', os.getpid())
+                break
+            server.handle_request()
+
+    def _reap(self):
+        """
+        Forgets workers that exited.
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            self.children.discard(pid)
+
+    def _stop_children(self, children, wait=True):
+        """
+        Asks workers to finish current request and exit.
+        """
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        if wait:
+            for pid in children:
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+
+    def _stop(self, *args):
+        self.running = False
+
+    def _request_reload(self, *args):
+        self.reload_requested = True
+
+
+def load_data():
+    """
+    Loads data in master, workers then use it without checking files.
+    """
+    refresh_data()
+    get_dataset.cache.background = True
+    get_sqlite_repository.cache.background = True
+    get_users_directory.cache.background = True
+
+
+def data_files_version():
+    """
+    Returns identities of data files, the master reloads when they change.
+    """
+    keys = ('DATA_CSV', 'DATA_PATH')
+    if app.config.get('DATA_BACKEND', 'memory') == 'sqlite':
+        keys = ('DATA_SQLITE', 'DATA_PATH')
+    return tuple(file_identity(app.config[key]) for key in keys)
+
+
+def serve(host, port, workers, max_requests=0, check_interval=30):
+    """
+    Serves the app from forked workers sharing data loaded once.
+    """
+    PreforkServer(
+        app, (host, port), workers, max_requests, check_interval,
+        load=load_data, version=data_files_version,
+    ).serve_forever()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling of API requests with cProfile.
+
+With PROFILING config option set, a client listed in PROFILING_ADDRESSES
+can have any /api/v1/ request profiled by adding `profile` query
+parameter, and one in PROFILING_SAMPLE_RATE requests is profiled on its
+own. Last PROFILING_KEEP profiles are kept in memory, see `PROFILES`.
+"""
+
+import marshal
+import pstats
+import threading
+from collections import deque, namedtuple
+from cProfile import Profile
+from datetime import datetime
+from itertools import count
+from StringIO import StringIO
+from timeit import default_timer
+
+from flask import g, request
+
+from presence_analyzer.main import app
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+# functions shown in reports, modules of this package by default
+REPORT_RESTRICTION = r'presence_analyzer/\w+\.py'
+
+ProfileRecord = namedtuple(
+    'ProfileRecord', ['id', 'path', 'created', 'seconds', 'profile']
+)
+
+
+class ProfileStore(object):
+    """
+    Last profiles of requests, oldest dropped first.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = deque()
+        self.ids = count(1)
+
+    def add(self, path, seconds, profile, keep):
+        """
+        Stores profile, keeping at most `keep` latest ones.
+        """
+        with self.lock:
+            record = ProfileRecord(next(self.ids), path, datetime.utcnow(),
+                                   seconds, profile)
+            self.records.append(record)
+            while len(self.records) > keep:
+                self.records.popleft()
+        return record
+
+    def get(self, profile_id):
+        """
+        Returns stored profile with given id or None.
+        """
+        with self.lock:
+            for record in self.records:
+                if record.id == profile_id:
+                    return record
+        return None
+
+    def list(self):
+        """
+        Returns stored profiles, latest first.
+        """
+        with self.lock:
+            return list(reversed(self.records))
+
+    def clear(self):
+        """
+        Drops stored profiles.
+        """
+        with self.lock:
+            self.records.clear()
+
+
+PROFILES = ProfileStore()
+
+# requests seen by sampling, see `should_profile`
+SAMPLED = count()
+
+
+def enabled():
+    """
+    Checks if profiling is switched on, see PROFILING config option.
+    """
+    return app.config.get('PROFILING', False)
+
+
+def client_allowed():
+    """
+    Checks if client of current request may use profiling.
+    """
+    return request.remote_addr in app.config.get(
+        'PROFILING_ADDRESSES', ('127.0.0.1', '::1')
+    )
+
+
+def should_profile():
+    """
+    Decides if current request is profiled.
+    """
+    if (not enabled() or not request.path.startswith('/api/v1/') or
+            request.path.startswith('/api/v1/profiles')):
+        return False
+    if 'profile' in request.args:
+        return client_allowed()
+    rate = app.config.get('PROFILING_SAMPLE_RATE', 0)
+    return bool(rate) and next(SAMPLED) % rate == 0
+
+
+def start_request():
+    """
+    Starts profiling current request when it should be profiled.
+    """
+    if should_profile():
+        g.profile = Profile()
+        g.profile_started = default_timer()
+        g.profile.enable()
+
+
+def finish_request(response):
+    """
+    Stores profile of current request, its id is sent in X-Profile-Id.
+    """
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    profile.disable()
+    record = PROFILES.add(
+        request.full_path.rstrip('?'),
+        default_timer() - g.pop('profile_started'),
+        profile,
+        app.config.get('PROFILING_KEEP', 20),
+    )
+    log.debug('Request %s profiled as %d', record.path, record.id)
+    response.headers['X-Profile-Id'] = str(record.id)
+    return response
+
+
+def abandon_request():
+    """
+    Stops profiling of request that failed before its response was made.
+    """
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.disable()
+
+
+def report(record, limit=30):
+    """
+    Returns text report of functions taking most cumulative time.
+    """
+    stream = StringIO()
+    stream.write('%s\nprofiled at %s, %.6fs\n\n' % (
+        record.path, record.created.isoformat(), record.seconds,
+    ))
+    stats = pstats.Stats(record.profile, stream=stream)
+    stats.sort_stats('cumulative').print_stats(REPORT_RESTRICTION, limit)
+    return stream.getvalue()
+
+
+def dump(record):
+    """
+    Returns profile in the binary format of `pstats.Stats.dump_stats`.
+    """
+    record.profile.create_stats()
+    return marshal.dumps(record.profile.stats)
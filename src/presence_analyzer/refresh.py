@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Refreshing of data files from their sources.
+"""
+
+import os
+import urllib2
+import tempfile
+import threading
+from email.utils import formatdate, mktime_tz, parsedate_tz
+
+from presence_analyzer.main import app
+from presence_analyzer.utils import (
+    get_dataset,
+    get_sqlite_repository,
+    get_users_directory,
+)
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _etag_path(path):
+    """
+    Returns path of file keeping ETag of downloaded file.
+    """
+    return path + '.etag'
+
+
+def _read_etag(path):
+    """
+    Returns ETag saved with downloaded file or None.
+    """
+    try:
+        with open(_etag_path(path)) as etag_file:
+            return etag_file.read().strip() or None
+    except IOError:
+        return None
+
+
+def _http_date(value):
+    """
+    Converts HTTP date to timestamp, returns None for invalid ones.
+    """
+    parsed = parsedate_tz(value) if value else None
+    return mktime_tz(parsed) if parsed else None
+
+
+def _replace(path, chunks, mtime=None):
+    """
+    Writes chunks to temporary file and atomically renames it to `path`.
+    """
+    handle, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.',
+        prefix='.%s.' % os.path.basename(path),
+    )
+    try:
+        with os.fdopen(handle, 'wb') as temp_file:
+            for chunk in chunks:
+                temp_file.write(chunk)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.chmod(temp_path, 0644)
+        if mtime is not None:
+            os.utime(temp_path, (mtime, mtime))
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+
+def download(url, path, timeout=60):
+    """
+    Downloads file from url to path unless it has not changed since.
+
+    Sends If-Modified-Since based on mtime of current file and
+    If-None-Match with ETag of last download, the body is streamed to
+    disk and swapped in atomically, so readers never see partial file.
+    Returns True when the file was replaced.
+    """
+    request = urllib2.Request(url)
+    if os.path.exists(path):
+        request.add_header(
+            'If-Modified-Since',
+            formatdate(os.path.getmtime(path), usegmt=True),
+        )
+        etag = _read_etag(path)
+        if etag:
+            request.add_header('If-None-Match', etag)
+
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as error:
+        if error.code == 304:
+            log.info('%s not modified', url)
+            return False
+        raise
+
+    try:
+        headers = response.info()
+        last_modified = _http_date(headers.getheader('Last-Modified'))
+        if (last_modified is not None and os.path.exists(path) and
+                last_modified <= os.path.getmtime(path)):
+            # server ignored conditional headers
+            log.info('%s not newer than %s', url, path)
+            return False
+        _replace(
+            path,
+            iter(lambda: response.read(CHUNK_SIZE), ''),
+            last_modified,
+        )
+    finally:
+        response.close()
+
+    etag = headers.getheader('ETag')
+    if etag:
+        _replace(_etag_path(path), [etag])
+    elif os.path.exists(_etag_path(path)):
+        os.unlink(_etag_path(path))
+    log.info('%s downloaded to %s', url, path)
+    return True
+
+
+def notify(url, timeout=10):
+    """
+    Asks running app to drop cached data, see `views.invalidate_view`.
+    """
+    try:
+        urllib2.urlopen(urllib2.Request(url, data=''), timeout=timeout).close()
+    except (urllib2.URLError, IOError):
+        log.warning('Problem with notifying %s', url, exc_info=True)
+        return False
+    return True
+
+
+def refresh_users_data(url, path, notify_url=None):
+    """
+    Downloads users data and notifies the app when it has changed.
+    """
+    if not download(url, path):
+        return False
+    if notify_url:
+        notify(notify_url)
+    return True
+
+
+def refresh_data():
+    """
+    Loads changed data files together with everything derived from them.
+    """
+    if app.config.get('DATA_BACKEND', 'memory') == 'sqlite':
+        get_sqlite_repository.refresh()
+    else:
+        # team aggregates are built lazily, do it here, not in a request
+        get_dataset.refresh().build_team_aggregates()
+    get_users_directory.refresh()
+
+
+class Refresher(threading.Thread):
+    """
+    Background thread refreshing data files every `interval` seconds.
+
+    Once data is loaded, request threads are served cached versions
+    without checking the files, so parsing never happens on request
+    path and new versions are swapped in when they are ready.
+    """
+
+    def __init__(self, interval):
+        super(Refresher, self).__init__(name='presence-data-refresher')
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def refresh(self):
+        """
+        Refreshes data, errors are logged and retried on next round.
+        """
+        try:
+            refresh_data()
+        except Exception:
+            log.exception('Problem with refreshing data')
+            return False
+        get_dataset.cache.background = True
+        get_sqlite_repository.cache.background = True
+        get_users_directory.cache.background = True
+        return True
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.refresh()
+
+    def stop(self):
+        """
+        Stops refreshing and switches request threads to checking files.
+        """
+        self.stopped.set()
+        get_dataset.cache.background = False
+        get_sqlite_repository.cache.background = False
+        get_users_directory.cache.background = False
+
+
+REFRESHER = None
+
+
+def start_refresher(interval):
+    """
+    Loads data and starts background refresher, once per process.
+    """
+    global REFRESHER  # pylint: disable-msg=W0603
+    if REFRESHER is None or not REFRESHER.is_alive():
+        REFRESHER = Refresher(interval)
+        REFRESHER.refresh()
+        REFRESHER.start()
+    return REFRESHER
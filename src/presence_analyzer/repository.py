@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data backends behind one interface used by views.
+
+Repositories answer weekday aggregates and histograms of users and
+periods, see `dataset.WeekdayAggregate` and `dataset.WeekdayHistograms`,
+and stream entries as (day ordinal, start seconds, end seconds).
+`version` identifies the data they serve.
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+
+from presence_analyzer.cache import file_identity
+from presence_analyzer.dataset import (
+    BIN_SECONDS,
+    BINS,
+    HISTOGRAM_KINDS,
+    WeekdayAggregate,
+    WeekdayHistograms,
+    build_histograms,
+    empty_bins,
+    weekday,
+)
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+class DatasetRepository(object):
+    """
+    Repository of in-memory `dataset.Dataset`.
+    """
+
+    def __init__(self, dataset, version):
+        self.dataset = dataset
+        self.version = version
+
+    def __contains__(self, user_id):
+        return user_id in self.dataset
+
+    def user_ids(self):
+        """
+        Returns sorted ids of users with presence data.
+        """
+        return sorted(self.dataset.users)
+
+    def weekdays(self, user_id, period=None):
+        """
+        Returns seven `WeekdayAggregate` of user, optionally in a period.
+
+        Period is (first_day, last_day) of day ordinals, both included.
+        """
+        if period is not None:
+            return self.dataset.period_weekdays(user_id, *period)
+        return self.dataset.weekdays[user_id]
+
+    def team_weekdays(self):
+        """
+        Returns seven `WeekdayAggregate` of all users together.
+        """
+        return self.dataset.team_weekdays
+
+    def histograms(self, user_id, period=None):
+        """
+        Returns seven `WeekdayHistograms` of user, optionally in a period.
+
+        Histograms of periods are counted from entries of the period.
+        """
+        if period is not None:
+            return build_histograms(self.entries(user_id, *period))
+        return self.dataset.user_histograms(user_id)
+
+    def team_histograms(self):
+        """
+        Returns seven `WeekdayHistograms` of all users together.
+        """
+        return self.dataset.team_histograms
+
+    def entries(self, user_id, first_day, last_day):
+        """
+        Yields (day, start, end) of user's entries in a period by day.
+        """
+        presence = self.dataset.users.get(user_id)
+        if presence is None:
+            return
+        low, high = presence.bounds(first_day, last_day)
+        for i in xrange(low, high):
+            yield presence.days[i], presence.starts[i], presence.ends[i]
+
+
+SCHEMA = """
+CREATE TABLE presence (
+    user_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    weekday INTEGER NOT NULL,
+    start_seconds INTEGER NOT NULL,
+    end_seconds INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID
+"""
+
+# bin counts of users, kind being index in `dataset.HISTOGRAM_KINDS`
+HISTOGRAM_SCHEMA = """
+CREATE TABLE histogram (
+    user_id INTEGER NOT NULL,
+    weekday INTEGER NOT NULL,
+    kind INTEGER NOT NULL,
+    bin INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (user_id, weekday, kind, bin)
+) WITHOUT ROWID
+"""
+
+# fills histogram table, binning seconds like `dataset.WeekdayHistograms`
+HISTOGRAM_INSERT = """
+INSERT INTO histogram
+SELECT user_id, weekday, %%d, MIN(MAX((%%s) / %d, 0), %d), COUNT(*)
+FROM presence
+GROUP BY 1, 2, 4
+""" % (BIN_SECONDS, BINS - 1)
+
+HISTOGRAM_COLUMNS = {
+    'arrival': 'start_seconds',
+    'departure': 'end_seconds',
+    'duration': 'end_seconds - start_seconds',
+}
+
+WEEKDAYS_QUERY = """
+SELECT weekday, COUNT(*), SUM(end_seconds - start_seconds),
+       SUM(start_seconds), SUM(end_seconds)
+FROM presence %s
+GROUP BY weekday
+"""
+
+
+class SqliteRepository(object):
+    """
+    Repository of presence table in SQLite database, see `import_sqlite`.
+
+    Aggregates are computed by SQL queries using the (user_id, day)
+    primary key, so only the pages of queried rows are read. Every
+    thread gets its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.version = file_identity(path)
+        self.local = threading.local()
+
+    def connection(self):
+        """
+        Returns connection of current thread.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            if not os.path.exists(self.path):
+                raise IOError('No SQLite database at %s' % self.path)
+            connection = self.local.connection = sqlite3.connect(self.path)
+        return connection
+
+    def __contains__(self, user_id):
+        return self.connection().execute(
+            'SELECT 1 FROM presence WHERE user_id = ? LIMIT 1', (user_id, )
+        ).fetchone() is not None
+
+    def user_ids(self):
+        """
+        Returns sorted ids of users with presence data.
+        """
+        return [
+            row[0] for row in self.connection().execute(
+                'SELECT DISTINCT user_id FROM presence ORDER BY user_id'
+            )
+        ]
+
+    def _weekdays(self, where, parameters):
+        """
+        Runs weekday aggregates query with given condition.
+        """
+        result = [WeekdayAggregate() for i in range(7)]
+        for i, count, total, start, end in self.connection().execute(
+                WEEKDAYS_QUERY % where, parameters):
+            aggregate = result[i]
+            aggregate.count = count
+            aggregate.total = total
+            aggregate.start = start
+            aggregate.end = end
+        return result
+
+    def weekdays(self, user_id, period=None):
+        """
+        Returns seven `WeekdayAggregate` of user, optionally in a period.
+        """
+        if period is not None:
+            return self._weekdays(
+                'WHERE user_id = ? AND day BETWEEN ? AND ?',
+                (user_id, ) + tuple(period),
+            )
+        return self._weekdays('WHERE user_id = ?', (user_id, ))
+
+    def team_weekdays(self):
+        """
+        Returns seven `WeekdayAggregate` of all users together.
+        """
+        return self._weekdays('', ())
+
+    def _histograms(self, query, parameters):
+        """
+        Runs query of (weekday, kind, bin, count) rows into histograms.
+        """
+        bins = empty_bins()
+        for i, kind, position, count in self.connection().execute(
+                query, parameters):
+            bins[i][kind][position] = count
+        return [WeekdayHistograms(*counts) for counts in bins]
+
+    def histograms(self, user_id, period=None):
+        """
+        Returns seven `WeekdayHistograms` of user, optionally in a period.
+        """
+        if period is not None:
+            return build_histograms(self.entries(user_id, *period))
+        return self._histograms(
+            'SELECT weekday, kind, bin, count FROM histogram '
+            'WHERE user_id = ?',
+            (user_id, ),
+        )
+
+    def team_histograms(self):
+        """
+        Returns seven `WeekdayHistograms` of all users together.
+        """
+        return self._histograms(
+            'SELECT weekday, kind, bin, SUM(count) FROM histogram '
+            'GROUP BY weekday, kind, bin',
+            (),
+        )
+
+    def entries(self, user_id, first_day, last_day):
+        """
+        Yields (day, start, end) of user's entries in a period by day.
+        """
+        return self.connection().execute(
+            'SELECT day, start_seconds, end_seconds FROM presence '
+            'WHERE user_id = ? AND day BETWEEN ? AND ? ORDER BY day',
+            (user_id, first_day, last_day),
+        )
+
+
+def import_sqlite(entries, path):
+    """
+    Writes presence entries to SQLite database, replacing it atomically.
+
+    Entries are (user_id, day, start, end) tuples of a parse engine,
+    inserted as they come, so a later entry of user's day replaces the
+    earlier one like in `dataset.UserPresence.finalize`. Histograms of
+    users are counted once all entries are in.
+    Returns number of rows in the database.
+    """
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    os.close(handle)
+    try:
+        connection = sqlite3.connect(temp_path)
+        try:
+            connection.execute('PRAGMA journal_mode = OFF')
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute(SCHEMA)
+            connection.executemany(
+                'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?, ?)',
+                (
+                    (user_id, day, weekday(day), start, end)
+                    for user_id, day, start, end in entries
+                ),
+            )
+            connection.execute(HISTOGRAM_SCHEMA)
+            for kind, name in enumerate(HISTOGRAM_KINDS):
+                connection.execute(
+                    HISTOGRAM_INSERT % (kind, HISTOGRAM_COLUMNS[name])
+                )
+            connection.commit()
+            rows = connection.execute(
+                'SELECT COUNT(*) FROM presence'
+            ).fetchone()[0]
+        finally:
+            connection.close()
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+    log.info('%d presence rows imported to %s', rows, path)
+    return rows
@@ -4,13 +4,11 @@
 
 import os
 import sys
+import locale
 from functools import partial
 
 import paste.script.command
 import werkzeug.script
-import urllib2
-from datetime import datetime
-from time import ctime
 
 etc = partial(os.path.join, 'parts', 'etc')
 
@@ -28,18 +26,32 @@ abspath = partial(os.path.join, _buildout_path)
 del _buildout_path
 
 
-# bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False,
+             refresher=False):
     from presence_analyzer import app
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    # users are sorted by name in user's locale, set once for the process
+    try:
+        locale.setlocale(locale.LC_COLLATE, '')
+    except locale.Error:
+        pass
+    if refresher and app.config.get('REFRESH_INTERVAL'):
+        from presence_analyzer.refresh import start_refresher
+        start_refresher(app.config['REFRESH_INTERVAL'])
     return app
 
 
+# bin/paster serve parts/etc/deploy.ini
+def make_main(global_conf={}, **conf):
+    return make_app(global_conf, refresher=True)
+
+
 # bin/paster serve parts/etc/debug.ini
 def make_debug(global_conf={}, **conf):
     from werkzeug.debug import DebuggedApplication
-    app = make_app(global_conf, config=DEBUG_CFG, debug=True)
+    app = make_app(global_conf, config=DEBUG_CFG, debug=True,
+                   refresher=True)
     return DebuggedApplication(app, evalex=True)
 
 
@@ -113,22 +125,179 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
-    werkzeug.script.run()
+    # bin/flask-ctl prefork [--workers=N] [--port=8080]
+    def action_prefork(workers=('w', 0), host=('h', '0.0.0.0'),
+                       port=('p', 8080), max_requests=-1):
+        """Serve the application from pre-forked worker processes.
 
+        The master loads the data once and forks workers sharing it,
+        when data files change it reloads and replaces the workers.
 
-def update_users_data():
-    def get_modify_date(path):
-        date = datetime.strptime(
-            ctime(os.path.getmtime(path)),
-            '%a %b %d %H:%M:%S %Y',
+        Options:
+         - '--workers' PREFORK_WORKERS config option by default
+         - '--max-requests' requests served before a worker is replaced,
+           PREFORK_MAX_REQUESTS config option by default, 0 for no limit
+        """
+        from presence_analyzer.prefork import serve
+        # threads don't survive fork, the master checks data files itself
+        app = make_app()
+        if max_requests < 0:
+            max_requests = app.config.get('PREFORK_MAX_REQUESTS', 0)
+        serve(
+            host, port,
+            workers or app.config.get('PREFORK_WORKERS', 4),
+            max_requests,
+            app.config.get('REFRESH_INTERVAL') or 30,
         )
-        return date
 
+    # bin/flask-ctl benchmark [--sizes=15000,100000] [--baseline=path]
+    def action_benchmark(sizes=('s', ''), repeat=('r', 3),
+                         output=('o', 'var/benchmark.json'), baseline='',
+                         tolerance=0.2, workers=('w', '')):
+        """Time parsing, aggregation and views on generated data.
+
+        Options:
+         - '--sizes' comma separated rows counts, 15k to 10M by default
+         - '--output' JSON file results are written to
+         - '--baseline' results to compare with, exits with status 1
+           when a case got slower by more than '--tolerance' fraction
+         - '--workers' comma separated process counts to time parallel
+           loading of every size with, e.g. 1,2,4,8
+        """
+        import logging
+        from presence_analyzer import benchmark
+        logging.basicConfig(level=logging.INFO)
+        make_app()
+        sizes = [int(rows) for rows in sizes.split(',')] if sizes else (
+            benchmark.SIZES)
+        report = benchmark.run(sizes, repeat)
+        if workers:
+            for rows in sizes:
+                results = benchmark.run_ingestion(
+                    rows, [int(count) for count in workers.split(',')],
+                    repeat,
+                )
+                for result in results:
+                    print '%-45s %9d %10.6f %6.2fx' % (
+                        result['name'], rows, result['best'],
+                        result['speedup'],
+                    )
+                report['results'].extend(results)
+        benchmark.save(report, abspath(output))
+        print 'Results written to %s' % output
+        if not baseline:
+            return
+        regressions = 0
+        for (name, rows, previous, seconds, ratio,
+             regressed) in benchmark.compare(
+                 report, benchmark.load(abspath(baseline)), tolerance):
+            print '%-45s %9d %10.6f %10.6f %6.2fx%s' % (
+                name, rows, previous, seconds, ratio,
+                ' REGRESSION' if regressed else '',
+            )
+            regressions += regressed
+        if regressions:
+            sys.exit(1)
+
+    # bin/flask-ctl snapshot [--output=path]
+    def action_snapshot(output=''):
+        """Compile presence CSV into a memory-mappable snapshot.
+
+        Options:
+         - '--output' snapshot path, DATA_SNAPSHOT config option by default
+        """
+        from presence_analyzer.snapshot import write_snapshot
+        from presence_analyzer.utils import load_dataset
+        app = make_app()
+        output = output or app.config['DATA_SNAPSHOT']
+        write_snapshot(load_dataset(app.config['DATA_CSV']), output)
+        print 'Snapshot written to %s' % output
+
+    # bin/flask-ctl import_sqlite [--output=path]
+    def action_import_sqlite(output=''):
+        """Import presence CSV into SQLite database of sqlite backend.
+
+        Options:
+         - '--output' database path, DATA_SQLITE config option by default
+        """
+        from presence_analyzer.utils import import_sqlite_data
+        app = make_app()
+        output = output or app.config['DATA_SQLITE']
+        rows = import_sqlite_data(app.config['DATA_CSV'], output)
+        print '%d rows imported to %s' % (rows, output)
+
+    # bin/flask-ctl memory
+    def action_memory():
+        """Compare memory taken by columnar and dict presence data."""
+        from presence_analyzer.dataset import memory_report
+        from presence_analyzer.utils import get_dataset, read_data
+        app = make_app()
+        report = memory_report(
+            get_dataset(),
+            read_data(app.config['DATA_CSV']),
+        )
+        for key in ('users', 'entries', 'columnar_bytes', 'histogram_bytes',
+                    'dict_bytes'):
+            print '%s: %s' % (key, report[key])
+
+    werkzeug.script.run()
+
+
+def update_users_data():
+    from presence_analyzer.refresh import refresh_users_data
     app = make_app()
-    response = urllib2.urlopen(app.config['DATA_URL'])
-    modify_date = response.info()['Last-Modified']
-    modify_date = datetime.strptime(modify_date, '%a, %d %b %Y %H:%M:%S GMT')
-    if (not os.path.exists(app.config['DATA_PATH'])) or \
-       get_modify_date(app.config['DATA_PATH']) < modify_date:
-        with open(app.config['DATA_PATH'], 'wb') as user_file:
-            user_file.write(response.read())
+    refresh_users_data(
+        app.config['DATA_URL'],
+        app.config['DATA_PATH'],
+        app.config.get('USERS_NOTIFY_URL'),
+    )
+
+
+# bin/generate-data presence.csv users.xml --users=1000 --years=5
+def generate_data():
+    """Generate synthetic presence CSV and users XML for load testing."""
+    import logging
+    from argparse import ArgumentParser
+    from datetime import datetime
+    from presence_analyzer import generator
+    parser = ArgumentParser(description=generate_data.__doc__)
+    parser.add_argument('csv', help='presence CSV output path')
+    parser.add_argument('xml', nargs='?', help='users XML output path')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument('--first-day', default='2011-01-03',
+                        help='YYYY-MM-DD of first day of history')
+    parser.add_argument('--arrival', default='9:00',
+                        help='mean arrival time, H:MM')
+    parser.add_argument('--arrival-spread', type=int, default=45,
+                        help='standard deviation of arrival in minutes')
+    parser.add_argument('--departure', default='17:00',
+                        help='mean departure time, H:MM')
+    parser.add_argument('--departure-spread', type=int, default=60,
+                        help='standard deviation of departure in minutes')
+    parser.add_argument('--absence', type=float, default=0.05,
+                        help='fraction of workdays users are absent')
+    parser.add_argument('--no-holidays', dest='holidays',
+                        action='store_false',
+                        help='users are present on public holidays')
+    parser.add_argument('--malformed', type=float, default=0.0,
+                        help='fraction of malformed lines')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    generator.write_presence_csv(
+        args.csv, args.users,
+        years=args.years,
+        first_day=datetime.strptime(args.first_day, '%Y-%m-%d').date(),
+        arrival=generator.parse_clock(args.arrival),
+        arrival_spread=args.arrival_spread * 60,
+        departure=generator.parse_clock(args.departure),
+        departure_spread=args.departure_spread * 60,
+        absence=args.absence,
+        holidays=args.holidays,
+        malformed=args.malformed,
+        seed=args.seed,
+    )
+    if args.xml:
+        generator.write_users_xml(args.xml, args.users, seed=args.seed)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshot of presence dataset, memory-mapped on load.
+
+Layout, all numbers little-endian:
+
+    header    magic, format version, users and entries count and
+              `parsers.Source` of the CSV file the snapshot was made of
+    users     per user: user_id, index of first entry, entries count
+    weekdays  per user seven times: count, total, start and end sums
+    days      day ordinals of all entries, grouped by user
+    starts    start seconds of all entries
+    ends      end seconds of all entries
+
+Columns are read straight from the mapping, so opening a snapshot only
+reads the users table and forked workers share the OS page cache.
+"""
+
+import os
+import sys
+import errno
+import mmap
+import struct
+import tempfile
+from array import array
+
+from presence_analyzer.dataset import Dataset, UserPresence, WeekdayAggregate
+from presence_analyzer.parsers import Source
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+MAGIC = 'PRESNAP\0'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<8sIIIQQi')
+USER = struct.Struct('<iII')
+WEEKDAYS = struct.Struct('<' + 'qqqq' * 7)
+ITEM_SIZE = 4
+
+
+class MappedColumn(object):
+    """
+    Read-only sequence of 32-bit integers stored in a memory map.
+    """
+    __slots__ = ('buf', 'offset', 'length')
+
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return struct.unpack_from('<i', self.buf,
+                                  self.offset + i * ITEM_SIZE)[0]
+
+    def __iter__(self):
+        chunk = 4096
+        for start in xrange(0, self.length, chunk):
+            count = min(chunk, self.length - start)
+            for value in struct.unpack_from(
+                    '<%di' % count, self.buf,
+                    self.offset + start * ITEM_SIZE):
+                yield value
+
+
+def _column_bytes(column):
+    """
+    Returns array of integers as little-endian bytes.
+    """
+    column = array('i', column)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tostring()
+
+
+def write_snapshot(dataset, path):
+    """
+    Writes dataset to snapshot file, replacing it atomically.
+    """
+    user_ids = sorted(dataset.users)
+    users = []
+    first = 0
+    for user_id in user_ids:
+        count = len(dataset.users[user_id])
+        users.append(USER.pack(user_id, first, count))
+        first += count
+
+    source = dataset.source or Source(0, 0, 0)
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(handle, 'wb') as snapshot:
+            snapshot.write(HEADER.pack(
+                MAGIC, FORMAT_VERSION, len(user_ids), first,
+                source.inode, source.offset, source.signature,
+            ))
+            snapshot.write(''.join(users))
+            for user_id in user_ids:
+                snapshot.write(WEEKDAYS.pack(*[
+                    value
+                    for aggregate in dataset.weekdays[user_id]
+                    for value in (aggregate.count, aggregate.total,
+                                  aggregate.start, aggregate.end)
+                ]))
+            for name in ('days', 'starts', 'ends'):
+                for user_id in user_ids:
+                    snapshot.write(_column_bytes(
+                        getattr(dataset.users[user_id], name)
+                    ))
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+
+def open_snapshot(path):
+    """
+    Memory-maps snapshot file as dataset.
+
+    Returns None when there is no usable snapshot at given path.
+    """
+    try:
+        with open(path, 'rb') as snapshot:
+            buf = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError) as error:
+        if getattr(error, 'errno', None) == errno.ENOENT:
+            log.debug('No snapshot at %s', path)
+        else:
+            log.warning('Problem with snapshot %s', path, exc_info=True)
+        return None
+
+    if len(buf) < HEADER.size:
+        log.warning('Snapshot %s is truncated', path)
+        return None
+    (magic, version, users_count, entries_count,
+     inode, offset, signature) = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        log.warning('Snapshot %s has unknown format', path)
+        return None
+    weekdays_offset = HEADER.size + users_count * USER.size
+    days_offset = weekdays_offset + users_count * WEEKDAYS.size
+    column_size = entries_count * ITEM_SIZE
+    if len(buf) != days_offset + 3 * column_size:
+        log.warning('Snapshot %s is truncated', path)
+        return None
+
+    users = {}
+    weekdays = {}
+    for i in xrange(users_count):
+        user_id, first, count = USER.unpack_from(
+            buf, HEADER.size + i * USER.size
+        )
+        presence = UserPresence()
+        presence.days, presence.starts, presence.ends = [
+            MappedColumn(buf, column_offset + first * ITEM_SIZE, count)
+            for column_offset in (days_offset,
+                                  days_offset + column_size,
+                                  days_offset + 2 * column_size)
+        ]
+        users[user_id] = presence
+
+        sums = WEEKDAYS.unpack_from(buf, weekdays_offset + i * WEEKDAYS.size)
+        weekdays[user_id] = []
+        for j in range(0, len(sums), 4):
+            aggregate = WeekdayAggregate()
+            (aggregate.count, aggregate.total,
+             aggregate.start, aggregate.end) = sums[j:j + 4]
+            weekdays[user_id].append(aggregate)
+
+    return Dataset(users, weekdays, Source(inode, offset, signature))
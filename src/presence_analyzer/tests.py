@@ -4,12 +4,39 @@ Presence analyzer unit tests.
 """
 import os.path
 import json
+import marshal
 import datetime
 import unittest
 import random
 import calendar
+import shutil
+import tempfile
+import threading
+import time
+import signal
+import urllib2
+import BaseHTTPServer
+from email.utils import formatdate
+from gzip import GzipFile
+from StringIO import StringIO
 from mock import patch
-from presence_analyzer import main, views, utils
+from presence_analyzer import (
+    main,
+    views,
+    utils,
+    parsers,
+    dataset,
+    refresh,
+    prefork,
+    benchmark,
+    generator,
+    metrics,
+    profiling,
+    ingest,
+    snapshot,
+)
+from presence_analyzer.cache import FileCache, ResponseCache, file_identity
+from presence_analyzer.snapshot import open_snapshot, write_snapshot
 
 
 TEST_DATA_CSV = os.path.join(
@@ -20,17 +47,41 @@ TEST_USERS_DATA = os.path.join(
 )
 
 
+def weekday_sums(weekdays):
+    """
+    Returns sums kept in weekday aggregates as comparable tuples.
+    """
+    return [
+        (aggregate.count, aggregate.total, aggregate.start, aggregate.end)
+        for aggregate in weekdays
+    ]
+
+
+def histogram_counts(histograms):
+    """
+    Returns bin counts of weekday histograms as comparable lists.
+    """
+    return [
+        [list(getattr(weekday_histograms, kind))
+         for kind in dataset.HISTOGRAM_KINDS]
+        for weekday_histograms in histograms
+    ]
+
+
 # pylint: disable=E1103
 class PresenceAnalyzerViewsTestCase(unittest.TestCase):
     """
     Views tests.
     """
+    backend = 'memory'
 
     def setUp(self):
         """
         Before each test, set up a environment.
         """
         main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_PATH': TEST_USERS_DATA})
+        utils.RESPONSE_CACHE.clear()
         self.client = main.app.test_client()
         self.test_data = utils.get_data()
 
@@ -79,6 +130,21 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             }
         )
 
+    def test_api_users_without_presence_data(self):
+        """
+        Test users listing doesn't depend on presence data.
+        """
+        etag = self.client.get('/api/v1/users').headers['ETag']
+        main.app.config.update({'DATA_CSV': 'noexistspath'})
+        utils.get_dataset.cache.clear()
+        utils.RESPONSE_CACHE.clear()
+        with patch.object(utils, 'load_dataset') as load_dataset:
+            resp = self.client.get('/api/v1/users')
+            self.assertFalse(load_dataset.called)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(json.loads(resp.data)), 2)
+        self.assertEqual(resp.headers['ETag'], etag)
+
     def test_mean_time_weekday(self):
         """
         Test mean presence time of random user grouped by weekday.
@@ -156,6 +222,458 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertEqual(data, [])
 
+    def test_batch_view(self):
+        """
+        Test chart data of many users in one request.
+        """
+        for chart in ('mean_time_weekday', 'presence_weekday',
+                      'presence_start_end'):
+            resp = self.client.get('/api/v1/batch/%s?users=10,1' % chart)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content_type, 'application/json')
+            data = json.loads(resp.data)
+            self.assertEqual(data['1'], [])
+            single = self.client.get('/api/v1/%s/10' % chart)
+            self.assertEqual(data['10'], json.loads(single.data))
+
+            resp = self.client.get('/api/v1/batch/%s?users=all' % chart)
+            self.assertItemsEqual(json.loads(resp.data).keys(),
+                                  ['10', '11'])
+
+        resp = self.client.get('/api/v1/batch/presence_weekday?users=1a')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/batch/unknown?users=all')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_team_view(self):
+        """
+        Test chart data computed over all users.
+        """
+        resp = self.client.get('/api/v1/team/presence_weekday')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        users = [
+            json.loads(
+                self.client.get('/api/v1/presence_weekday/%s' % user_id).data
+            )
+            for user_id in (10, 11)
+        ]
+        self.assertEqual(
+            data[1:],
+            [[day, first + second]
+             for (day, first), (_, second) in zip(users[0][1:],
+                                                  users[1][1:])]
+        )
+
+        resp = self.client.get('/api/v1/team/mean_time_weekday')
+        data = json.loads(resp.data)
+        tuesdays = [
+            interval
+            for user_id in (10, 11)
+            for interval in utils.group_by_weekday(self.test_data[user_id])[1]
+        ]
+        self.assertEqual(data[1], [u'Tue', utils.mean(tuesdays)])
+        self.assertEqual(data[6], [u'Sun', 0])
+
+        resp = self.client.get('/api/v1/team/presence_start_end')
+        self.assertEqual(len(json.loads(resp.data)), 5)
+        resp = self.client.get('/api/v1/team/unknown')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_period_filter(self):
+        """
+        Test limiting charts to entries from given period.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11?from=2013-09-10&to=2013-09-12'
+        )
+        self.assertEqual(resp.status_code, 200)
+        data = dict(json.loads(resp.data)[1:])
+        self.assertEqual(data['Mon'], 0)
+        self.assertEqual(data['Tue'], 16564)
+        self.assertEqual(data['Fri'], 0)
+
+        resp = self.client.get('/api/v1/mean_time_weekday/11?to=2013-09-09')
+        self.assertEqual(
+            [day for day, mean_time in json.loads(resp.data) if mean_time],
+            ['Mon', 'Thu']
+        )
+        resp = self.client.get('/api/v1/presence_start_end/11?from=2013-09-13')
+        self.assertEqual(json.loads(resp.data),
+                         json.loads(self.client.get(
+                             '/api/v1/presence_start_end/11'
+                             '?from=2013-09-13&to=2013-09-13'
+                         ).data))
+        self.assertEqual(len(json.loads(resp.data)), 1)
+
+        resp = self.client.get('/api/v1/presence_weekday/10?from=')
+        self.assertEqual(resp.data, self.client.get(
+            '/api/v1/presence_weekday/10'
+        ).data)
+        resp = self.client.get(
+            '/api/v1/batch/presence_weekday?users=all&to=2000-01-01'
+        )
+        self.assertEqual(
+            [total for day, total in json.loads(resp.data)['10'][1:]],
+            [0] * 7
+        )
+        resp = self.client.get('/api/v1/presence_weekday/10?from=2013-13-01')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_presence_stats_view(self):
+        """
+        Test percentiles and histograms of arrival, departure and duration.
+        """
+        resp = self.client.get('/api/v1/presence_stats/11')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual([day for day, stats in data],
+                         ['Mon', 'Tue', 'Wed', 'Thu', 'Fri'])
+        thursday = dict(data)['Thu']
+        self.assertEqual(thursday['count'], 2)
+        self.assertLessEqual(thursday['arrival']['p10'],
+                             thursday['arrival']['median'])
+        self.assertLessEqual(thursday['arrival']['median'],
+                             thursday['arrival']['p90'])
+        # 10:18:36-16:41:25 on Thursday in the period
+        resp = self.client.get(
+            '/api/v1/presence_stats/11?from=2013-09-10&to=2013-09-12'
+        )
+        thursday = dict(json.loads(resp.data))['Thu']
+        self.assertEqual(thursday['count'], 1)
+        self.assertAlmostEqual(thursday['departure']['median'], 60085,
+                               delta=300)
+        self.assertEqual(
+            json.loads(self.client.get('/api/v1/presence_stats/1').data), []
+        )
+
+        resp = self.client.get('/api/v1/presence_histogram/10')
+        data = json.loads(resp.data)
+        self.assertEqual(data['bin_seconds'], 300)
+        self.assertEqual([day for day, histograms in data['weekdays']],
+                         ['Tue', 'Wed', 'Thu'])
+        tuesday = data['weekdays'][0][1]
+        self.assertEqual(sorted(tuesday),
+                         ['arrival', 'departure', 'duration'])
+        self.assertEqual(len(tuesday['arrival']), 288)
+        # 09:39:05 on Tuesday
+        self.assertEqual(tuesday['arrival'][34745 // 300], 1)
+
+        team = json.loads(
+            self.client.get('/api/v1/team/presence_histogram').data
+        )
+        self.assertEqual(dict(team['weekdays'])['Thu']['arrival'][
+            (10 * 3600 + 48 * 60) // 300], 1)
+        self.assertEqual(
+            sum(dict(team['weekdays'])['Thu']['duration']), 3
+        )
+        resp = self.client.get('/api/v1/team/presence_stats')
+        self.assertEqual(dict(json.loads(resp.data))['Thu']['count'], 3)
+
+        resp = self.client.get('/api/v1/batch/presence_stats?users=10,1')
+        data = json.loads(resp.data)
+        self.assertEqual(data['1'], [])
+        self.assertEqual(data['10'], json.loads(
+            self.client.get('/api/v1/presence_stats/10').data
+        ))
+
+    def test_export_view(self):
+        """
+        Test streaming export of presence data.
+        """
+        resp = self.client.get('/api/v1/export')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        with open(TEST_DATA_CSV) as csvfile:
+            self.assertEqual(resp.data.splitlines(),
+                             csvfile.read().splitlines())
+
+        resp = self.client.get(
+            '/api/v1/export?format=ndjson&users=11,1&from=2013-09-12'
+        )
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(
+            rows[0],
+            {u'user_id': 11, u'date': u'2013-09-12',
+             u'start': u'10:18:36', u'end': u'16:41:25'}
+        )
+        self.assertEqual(len(rows), 2)
+
+        chunks = list(views.export_rows(
+            utils.get_repository(), [10, 11],
+            (0, datetime.date.max.toordinal()),
+            views.csv_row, chunk_size=4
+        ))
+        self.assertEqual([chunk.count('\n') for chunk in chunks], [4, 4, 1])
+        resp = self.client.get('/api/v1/export?format=xml')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_response_cache(self):
+        """
+        Test caching of serialized responses of current data version.
+        """
+        stats = utils.RESPONSE_CACHE.stats
+        with patch.object(views, 'weekday_totals',
+                          wraps=views.weekday_totals) as totals:
+            first = self.client.get('/api/v1/presence_weekday/10').data
+            second = self.client.get('/api/v1/presence_weekday/10').data
+            self.assertEqual(first, second)
+            self.assertEqual(totals.call_count, 1)
+            self.client.get('/api/v1/presence_weekday/10?from=2013-09-11')
+            self.assertEqual(totals.call_count, 2)
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+        # views versioned differently don't drop each other's bodies
+        for url in ('/api/v1/users', '/api/v1/presence_weekday/10') * 2:
+            self.client.get(url)
+        self.assertEqual((stats['hits'], stats['misses']), (4, 3))
+        self.assertEqual(stats['invalidations'], 0)
+
+        main.app.config.update({'RESPONSE_CACHE_BYTES': len(first) * 2})
+        try:
+            for user_id in (10, 11, 10):
+                self.client.get('/api/v1/presence_weekday/%s' % user_id)
+            self.assertGreater(stats['evictions'], 0)
+            self.assertLessEqual(utils.RESPONSE_CACHE.size, len(first) * 2)
+        finally:
+            del main.app.config['RESPONSE_CACHE_BYTES']
+
+        cache = ResponseCache()
+        cache.put('key', 1, 'body', 100)
+        self.assertEqual(cache.get('key', 1), 'body')
+        self.assertIsNone(cache.get('key', 2))
+        self.assertEqual(cache.stats['invalidations'], 1)
+        cache.put('key', 2, 'x' * 101, 100)
+        self.assertIsNone(cache.get('key', 2))
+        for key in ('a', 'b', 'a', 'c'):
+            if cache.get(key, 2) is None:
+                cache.put(key, 2, 'x' * 40, 100)
+        self.assertEqual(cache.entries.keys(), ['a', 'c'])
+        self.assertEqual(cache.stats['evictions'], 1)
+
+    def test_gzip_responses(self):
+        """
+        Test gzip compressed API and static responses.
+        """
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        main.app.config.update({'GZIP_MIN_BYTES': 0})
+        try:
+            plain = self.client.get('/api/v1/users')
+            resp = self.client.get('/api/v1/users', headers=headers)
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(
+                GzipFile(fileobj=StringIO(resp.data)).read(),
+                plain.data
+            )
+            self.assertNotEqual(resp.headers['ETag'], plain.headers['ETag'])
+            with patch.object(utils, 'gzip_bytes') as gzip_bytes:
+                again = self.client.get('/api/v1/users', headers=headers)
+                self.assertFalse(gzip_bytes.called)
+            self.assertEqual(again.data, resp.data)
+        finally:
+            del main.app.config['GZIP_MIN_BYTES']
+
+        resp = self.client.get('/api/v1/users', headers=headers)
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+        resp = self.client.get('/static/css/normalize.css', headers=headers)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        with open(os.path.join(main.app.static_folder, 'css',
+                               'normalize.css'), 'rb') as css:
+            self.assertEqual(GzipFile(fileobj=StringIO(resp.data)).read(),
+                             css.read())
+        etag = resp.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        resp.close()
+        resp = self.client.get(
+            '/static/css/normalize.css',
+            headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 304)
+        resp.close()
+        resp = self.client.get('/static/js/jquery.min.js', headers=headers)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        resp.close()
+        resp = self.client.get('/static/img/loading.gif', headers=headers)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp.close()
+
+    def test_conditional_requests(self):
+        """
+        Test answering conditional requests with 304.
+        """
+        url = '/api/v1/presence_weekday/10'
+        resp = self.client.get(url)
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        self.assertNotEqual(
+            self.client.get('/api/v1/users').headers['ETag'], etag
+        )
+
+        with patch.object(views, 'weekday_totals') as totals:
+            resp = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, '')
+            resp = self.client.get(
+                url,
+                headers={'If-Modified-Since': last_modified}
+            )
+            self.assertEqual(resp.status_code, 304)
+            self.assertFalse(totals.called)
+
+        resp = self.client.get(url, headers={'If-None-Match': '"other"'})
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(
+            url,
+            headers={'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['ETag'], etag)
+
+    def test_metrics_view(self):
+        """
+        Test request and phase timings in Prometheus format.
+        """
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 404)
+
+        main.app.config.update({'METRICS': True})
+        metrics.METRICS.clear()
+        utils.get_dataset.cache.clear()
+        try:
+            self.client.get('/api/v1/presence_weekday/10')
+            self.client.get('/api/v1/presence_weekday/11')
+            resp = self.client.get('/metrics')
+        finally:
+            main.app.config.update({'METRICS': False})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/plain')
+        lines = resp.data.splitlines()
+        self.assertIn(
+            'presence_request_duration_seconds_count'
+            '{endpoint="presence_weekday_view"} 2',
+            lines,
+        )
+        self.assertIn(
+            'presence_request_duration_seconds_bucket'
+            '{endpoint="presence_weekday_view",le="+Inf"} 2',
+            lines,
+        )
+        phases = {'aggregate': 2, 'serialize': 2}
+        if self.backend == 'memory':
+            phases.update({'load': 1, 'parse': 1})
+            self.assertIn('presence_dataset_rows 9', lines)
+            self.assertIn('presence_dataset_users 2', lines)
+            self.assertIn(
+                'presence_file_cache_events_total'
+                '{cache="dataset",event="misses"} 1',
+                lines,
+            )
+        for name, count in phases.iteritems():
+            self.assertIn(
+                'presence_phase_duration_seconds_bucket'
+                '{phase="%s",le="+Inf"} %d' % (name, count),
+                lines,
+            )
+        self.assertIn('presence_response_cache_entries 2', lines)
+
+        with patch.object(metrics.METRICS, 'observe_request') as observe:
+            self.client.get('/api/v1/presence_weekday/10')
+        self.assertFalse(observe.called)
+
+    def test_profiling(self):
+        """
+        Test profiling requests on demand and by sampling.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10?profile')
+        self.assertNotIn('X-Profile-Id', resp.headers)
+        self.assertEqual(self.client.get('/api/v1/profiles').status_code,
+                         404)
+
+        main.app.config.update({
+            'PROFILING': True,
+            'PROFILING_SAMPLE_RATE': 0,
+            'PROFILING_KEEP': 2,
+        })
+        profiling.PROFILES.clear()
+        try:
+            resp = self.client.get('/api/v1/presence_weekday/10')
+            self.assertNotIn('X-Profile-Id', resp.headers)
+            resp = self.client.get('/api/v1/presence_weekday/10?profile')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(json.loads(resp.data)), 8)
+            profile_id = int(resp.headers['X-Profile-Id'])
+
+            resp = self.client.get('/api/v1/profiles/%d' % profile_id)
+            self.assertEqual(resp.mimetype, 'text/plain')
+            self.assertIn('/api/v1/presence_weekday/10?profile', resp.data)
+            self.assertIn('views.py', resp.data)
+            self.assertIn('utils.py', resp.data)
+
+            resp = self.client.get(
+                '/api/v1/profiles/%d?format=pstats' % profile_id
+            )
+            self.assertEqual(resp.mimetype, 'application/octet-stream')
+            self.assertIsInstance(marshal.loads(resp.data), dict)
+
+            main.app.config.update({'PROFILING_SAMPLE_RATE': 2})
+            for i in range(4):
+                self.client.get('/api/v1/presence_weekday/11')
+            records = json.loads(self.client.get('/api/v1/profiles').data)
+            self.assertEqual(len(records), 2)
+            self.assertEqual(records[0]['path'],
+                             '/api/v1/presence_weekday/11')
+            self.assertGreater(records[0]['id'], records[1]['id'])
+            self.assertEqual(
+                self.client.get('/api/v1/profiles/%d' % profile_id)
+                .status_code,
+                404,
+            )
+
+            resp = self.client.get(
+                '/api/v1/profiles',
+                environ_base={'REMOTE_ADDR': '10.0.0.1'},
+            )
+            self.assertEqual(resp.status_code, 403)
+        finally:
+            main.app.config.update({
+                'PROFILING': False,
+                'PROFILING_SAMPLE_RATE': 0,
+            })
+            profiling.PROFILES.clear()
+
+
+# pylint: disable=E1103
+class PresenceAnalyzerSqliteViewsTestCase(PresenceAnalyzerViewsTestCase):
+    """
+    Views tests against SQLite backend.
+    """
+    backend = 'sqlite'
+
+    def setUp(self):
+        """
+        Before each test, import test data to SQLite database.
+        """
+        super(PresenceAnalyzerSqliteViewsTestCase, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        sqlite_path = os.path.join(self.temp_dir, 'presence.sqlite')
+        utils.import_sqlite_data(TEST_DATA_CSV, sqlite_path)
+        main.app.config.update({
+            'DATA_BACKEND': 'sqlite',
+            'DATA_SQLITE': sqlite_path,
+        })
+
+    def tearDown(self):
+        """
+        Switch back to in-memory backend.
+        """
+        main.app.config.update({'DATA_BACKEND': 'memory'})
+        shutil.rmtree(self.temp_dir)
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -168,6 +686,8 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         """
         main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
         main.app.config.update({'DATA_PATH': TEST_USERS_DATA})
+        utils.get_dataset.cache.clear()
+        utils.get_users_directory.cache.clear()
 
     def tearDown(self):
         """
@@ -188,6 +708,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(data[10][sample_date]['start'],
                          datetime.time(9, 39, 5))
 
+        utils.get_dataset.cache.clear()
         with patch('csv.reader') as mock_reader:
             mock_reader.return_value = [[],
                                         [1, 2, 3, 4, 5],
@@ -196,6 +717,382 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             data = utils.get_data()
             self.assertItemsEqual(data, {})
 
+    def test_get_data_cache(self):
+        """
+        Test caching of parsed CSV file until it changes.
+        """
+        stats = utils.get_dataset.cache.stats
+        data = utils.get_data()
+        self.assertIs(utils.get_data(), data)
+        self.assertEqual(
+            (stats['hits'], stats['misses'], stats['reloads']),
+            (1, 1, 0)
+        )
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            temp_csv = os.path.join(temp_dir, 'data.csv')
+            shutil.copy(TEST_DATA_CSV, temp_csv)
+            main.app.config.update({'DATA_CSV': temp_csv})
+            self.assertEqual(utils.get_data(), data)
+            self.assertEqual(stats['misses'], 2)
+
+            with open(temp_csv, 'a') as csvfile:
+                csvfile.write('\n12,2013-09-16,09:00:00,17:00:00\n')
+            self.assertItemsEqual(utils.get_data().keys(), [10, 11, 12])
+            self.assertEqual(stats['reloads'], 1)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_dataset_appended_rows(self):
+        """
+        Test merging rows appended to CSV file into cached dataset.
+        """
+        stats = utils.get_dataset.cache.stats
+
+        def assert_fully_loaded(loaded):
+            expected = utils.get_dataset.cache.loader(temp_csv)
+            self.assertEqual(loaded.data, expected.data)
+            for user_id in expected.weekdays:
+                self.assertEqual(
+                    weekday_sums(loaded.weekdays[user_id]),
+                    weekday_sums(expected.weekdays[user_id])
+                )
+                self.assertEqual(
+                    histogram_counts(loaded.user_histograms(user_id)),
+                    histogram_counts(expected.user_histograms(user_id))
+                )
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            temp_csv = os.path.join(temp_dir, 'data.csv')
+            shutil.copy(TEST_DATA_CSV, temp_csv)
+            main.app.config.update({'DATA_CSV': temp_csv})
+            first = utils.get_dataset()
+
+            with open(temp_csv, 'a') as csvfile:
+                csvfile.write('\n10,2013-09-16,08:00:00,16:00:00\n'
+                              '12,2013-09-16,09:00:00,17:00:00\n'
+                              '11,2013-09-10,07:00:00,19:00:00\n'
+                              '12,2013-09-17,09:0')
+            second = utils.get_dataset()
+            self.assertEqual(stats['updates'], 1)
+            self.assertEqual(len(first.data), 2)
+            assert_fully_loaded(second)
+
+            with open(temp_csv, 'a') as csvfile:
+                csvfile.write('0:00,17:00:00\n')
+            third = utils.get_dataset()
+            self.assertEqual(stats['updates'], 2)
+            self.assertEqual(len(third.data[12]), 2)
+            # histograms of users without new rows are kept
+            self.assertIs(third.user_histograms(10),
+                          second.user_histograms(10))
+            assert_fully_loaded(third)
+
+            with open(temp_csv, 'r+') as csvfile:
+                csvfile.write('11')
+            assert_fully_loaded(utils.get_dataset())
+            self.assertEqual(stats['updates'], 2)
+            self.assertEqual(stats['reloads'], 3)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_dataset_rewritten_middle(self):
+        """
+        Test reloading CSV file with a row rewritten in its middle.
+        """
+        stats = utils.get_dataset.cache.stats
+        temp_dir = tempfile.mkdtemp()
+        try:
+            temp_csv = os.path.join(temp_dir, 'data.csv')
+            start = datetime.date(2012, 1, 1)
+            with open(temp_csv, 'w') as csvfile:
+                for day in xrange(1000):
+                    csvfile.write('10,%s,09:00:00,17:00:00\n' % (
+                        start + datetime.timedelta(days=day)))
+            main.app.config.update({'DATA_CSV': temp_csv})
+            utils.get_dataset()
+
+            # same length rewrite far from both ends of the file
+            with open(temp_csv, 'r+') as csvfile:
+                csvfile.seek(os.path.getsize(temp_csv) // 2)
+                csvfile.readline()
+                csvfile.seek(csvfile.tell() + len('10,2013-06-01,'))
+                csvfile.write('08')
+            with open(temp_csv, 'a') as csvfile:
+                csvfile.write('11,2014-09-10,07:00:00,19:00:00\n')
+            dataset = utils.get_dataset()
+            self.assertEqual(stats['updates'], 0)
+            self.assertEqual(stats['reloads'], 1)
+            self.assertEqual(
+                dataset.data, utils.get_dataset.cache.loader(temp_csv).data
+            )
+            self.assertEqual(
+                len([row for row in dataset.data[10].values()
+                     if row['start'] == datetime.time(8, 0)]),
+                1
+            )
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_snapshot(self):
+        """
+        Test writing and memory-mapping of dataset snapshots.
+        """
+        temp_dir = tempfile.mkdtemp()
+        try:
+            temp_csv = os.path.join(temp_dir, 'data.csv')
+            temp_snapshot = os.path.join(temp_dir, 'data.snapshot')
+            shutil.copy(TEST_DATA_CSV, temp_csv)
+            expected = utils.load_dataset(temp_csv)
+            write_snapshot(expected, temp_snapshot)
+
+            self.assertEqual(os.stat(temp_snapshot).st_mode & 0777, 0644)
+            mapped = open_snapshot(temp_snapshot)
+            self.assertEqual(mapped.source, expected.source)
+            self.assertEqual(mapped.data, expected.data)
+            self.assertEqual(mapped.users[11].days[-1],
+                             expected.users[11].days[-1])
+            self.assertEqual(list(mapped.users[11].ends),
+                             list(expected.users[11].ends))
+            for user_id in expected.users:
+                self.assertEqual(weekday_sums(mapped.weekdays[user_id]),
+                                 weekday_sums(expected.weekdays[user_id]))
+                self.assertEqual(
+                    histogram_counts(mapped.user_histograms(user_id)),
+                    histogram_counts(expected.user_histograms(user_id))
+                )
+
+            main.app.config.update({
+                'DATA_CSV': temp_csv,
+                'DATA_SNAPSHOT': temp_snapshot,
+            })
+            with open(temp_csv, 'a') as csvfile:
+                csvfile.write('\n12,2013-09-16,09:00:00,17:00:00\n')
+            with patch.object(utils, 'load_dataset') as load_dataset:
+                dataset = utils.get_dataset()
+                self.assertFalse(load_dataset.called)
+            self.assertItemsEqual(dataset.data.keys(), [10, 11, 12])
+
+            with open(temp_snapshot, 'r+') as snapshot_file:
+                snapshot_file.write('broken')
+            utils.get_dataset.cache.clear()
+            self.assertIsNone(open_snapshot(temp_snapshot))
+            self.assertEqual(utils.get_dataset().data,
+                             utils.load_dataset(temp_csv).data)
+            with patch.object(snapshot.log, 'warning') as warning:
+                self.assertIsNone(open_snapshot('noexistspath'))
+                self.assertFalse(warning.called)
+                self.assertIsNone(open_snapshot(temp_dir))
+                self.assertTrue(warning.called)
+        finally:
+            main.app.config.pop('DATA_SNAPSHOT', None)
+            shutil.rmtree(temp_dir)
+
+    def test_file_cache_single_flight(self):
+        """
+        Test that concurrent callers share a single load.
+        """
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def loader(path):
+            calls.append(path)
+            started.set()
+            release.wait()
+            return len(calls)
+
+        cache = FileCache(loader)
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(cache.get(TEST_DATA_CSV))
+            )
+            for i in range(5)
+        ]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [TEST_DATA_CSV])
+        self.assertEqual(results, [1] * 5)
+        self.assertEqual(cache.stats['misses'], 1)
+
+        # previous version is served while a reload is in flight
+        started.clear()
+        release.clear()
+        cache.entries[TEST_DATA_CSV] = ('old', 'previous')
+        reloader = threading.Thread(target=cache.get, args=(TEST_DATA_CSV, ))
+        reloader.start()
+        started.wait()
+        self.assertEqual(cache.get(TEST_DATA_CSV), 'previous')
+        self.assertEqual(cache.stats['stale'], 1)
+        release.set()
+        reloader.join()
+        self.assertEqual(cache.get(TEST_DATA_CSV), 2)
+
+    def test_dataset_weekday_aggregates(self):
+        """
+        Test weekday aggregates against grouping done per request.
+        """
+        loaded = utils.get_dataset()
+        self.assertIn(10, loaded)
+        self.assertNotIn(1, loaded)
+        for user_id, items in loaded.data.iteritems():
+            weekdays = utils.group_by_weekday(items)
+            weekday_aggregates = loaded.weekdays[user_id]
+            self.assertEqual(
+                dataset.weekday_totals(weekday_aggregates),
+                [(weekday, sum(intervals))
+                 for weekday, intervals in weekdays.items()]
+            )
+            self.assertEqual(
+                dataset.weekday_means(weekday_aggregates),
+                [(weekday, utils.mean(intervals))
+                 for weekday, intervals in weekdays.items()]
+            )
+            self.assertEqual(
+                dataset.weekday_start_end(weekday_aggregates),
+                utils.get_weekday_start_end(items)
+            )
+
+    def test_weekday_histograms(self):
+        """
+        Test weekday histograms and percentiles computed from them.
+        """
+        monday = datetime.date(2013, 9, 9).toordinal()
+        entries = [
+            (monday, 8 * 3600 + minutes * 60, 16 * 3600 + minutes * 60)
+            for minutes in range(100)
+        ]
+        entries.append((monday, 20 * 3600, 4 * 3600))
+        histograms = dataset.build_histograms(entries)[0]
+        self.assertEqual(histograms.count, 101)
+        # only bins from first to last non-empty one are stored
+        self.assertEqual(histograms.arrival.first, 8 * 12)
+        self.assertEqual(len(histograms.arrival.counts), 12 * 12 + 1)
+        self.assertEqual(histograms.arrival[0], 0)
+        self.assertEqual(sum(histograms.arrival), 101)
+        self.assertEqual(histograms.duration[0], 1)
+        self.assertEqual(histograms.departure[-1], 0)
+        p10, median, p90 = histograms.quantiles('arrival', (0.1, 0.5, 0.9))
+        self.assertAlmostEqual(p10, 8 * 3600 + 10 * 60,
+                               delta=dataset.BIN_SECONDS)
+        self.assertAlmostEqual(median, 8 * 3600 + 50 * 60,
+                               delta=dataset.BIN_SECONDS)
+        self.assertAlmostEqual(p90, 8 * 3600 + 90 * 60,
+                               delta=dataset.BIN_SECONDS)
+        self.assertEqual(
+            dataset.WeekdayHistograms().quantiles('arrival', (0.5, )),
+            [None]
+        )
+
+        loaded = utils.get_dataset()
+        for user_id, presence in loaded.users.iteritems():
+            self.assertEqual(
+                [weekday_histograms.count
+                 for weekday_histograms in loaded.user_histograms(user_id)],
+                [aggregate.count
+                 for aggregate in loaded.weekdays[user_id]]
+            )
+        team = loaded.team_histograms
+        self.assertEqual(
+            list(team[3].arrival),
+            [first + second for first, second in zip(
+                loaded.user_histograms(10)[3].arrival,
+                loaded.user_histograms(11)[3].arrival,
+            )]
+        )
+        statistics = dataset.weekday_statistics(loaded.user_histograms(11))
+        self.assertItemsEqual(statistics.keys(), range(5))
+        # single entry on Friday, 13:16:56-15:04:02
+        self.assertAlmostEqual(statistics[4]['arrival']['median'], 47816,
+                               delta=dataset.BIN_SECONDS)
+        self.assertAlmostEqual(statistics[4]['duration']['median'], 6426,
+                               delta=dataset.BIN_SECONDS)
+
+        user_histograms = loaded.user_histograms(11)
+        loaded.clear_derived()
+        self.assertIsNot(loaded.user_histograms(11), user_histograms)
+        team_weekdays, team_histograms = loaded.build_team_aggregates()
+        self.assertIs(loaded.team_weekdays, team_weekdays)
+        self.assertIs(loaded.team_histograms, team_histograms)
+        self.assertIsNot(team_histograms, team)
+        self.assertEqual(list(team_histograms[3].arrival),
+                         list(team[3].arrival))
+
+    def test_parse_engines(self):
+        """
+        Test that all parse engines give the same entries.
+        """
+        lines = [
+            'user_id,date,start,end\n',
+            '10,2013-09-10,09:39:05,17:59:52\n',
+            '10,2013-9-11,9:19:52,16:07:37\r\n',
+            '"11","2013-09-12","10:48:46","17:23:51"\n',
+            '11,2013-02-30,09:00:00,17:00:00\n',
+            '11,2013-09-13,24:00:00,17:00:00\n',
+            '11,2013-09-14,09:00:00,17:00:00 \n',
+            '1a,2013-09-15,09:00:00,17:00:00\n',
+            '12,2013-09-16,09:00:00\n',
+            '\n',
+        ]
+        expected = [
+            (10, datetime.date(2013, 9, 10).toordinal(), 34745, 64792),
+            (10, datetime.date(2013, 9, 11).toordinal(), 33592, 58057),
+            (11, datetime.date(2013, 9, 12).toordinal(), 38926, 62631),
+        ]
+        for name, parse in parsers.PARSE_ENGINES.items():
+            self.assertEqual(list(parse(iter(lines))), expected, name)
+
+        data = utils.read_data(TEST_DATA_CSV)
+        main.app.config.update({'DATA_PARSER': 'fast'})
+        try:
+            self.assertEqual(utils.read_data(TEST_DATA_CSV), data)
+        finally:
+            del main.app.config['DATA_PARSER']
+
+    def test_columnar_dataset(self):
+        """
+        Test columnar storage of presence entries.
+        """
+        data = dataset.Dataset.from_entries([
+            (10, 735000, 100, 200),
+            (10, 734990, 300, 400),
+            (10, 735000, 500, 600),
+            (11, 734000, 0, 1),
+        ])
+        presence = data.users[10]
+        self.assertEqual(list(presence.days), [734990, 735000])
+        self.assertEqual(list(presence.starts), [300, 500])
+        self.assertEqual(list(presence.ends), [400, 600])
+        self.assertEqual(presence.find(735000), 1)
+        self.assertEqual(presence.find(734995), -1)
+
+        items = data.data[10]
+        sample_date = datetime.date.fromordinal(735000)
+        self.assertEqual(len(items), 2)
+        self.assertEqual(list(items)[1], sample_date)
+        self.assertEqual(
+            items[sample_date],
+            {'start': datetime.time(0, 8, 20),
+             'end': datetime.time(0, 10, 0)}
+        )
+        self.assertNotIn(datetime.date.fromordinal(734995), items)
+
+        report = dataset.memory_report(
+            utils.get_dataset(),
+            utils.read_data(TEST_DATA_CSV)
+        )
+        self.assertEqual((report['users'], report['entries']), (2, 9))
+        self.assertLess(report['columnar_bytes'], report['dict_bytes'])
+        self.assertGreater(report['histogram_bytes'], 0)
+
     def test_get_users_data(self):
         """
         Test parsing xml with user data
@@ -216,6 +1113,348 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         main.app.config.update({'DATA_PATH': 'noexistspath'})
         self.assertEqual(({}, None), utils.get_users_data())
 
+    def test_get_users_directory(self):
+        """
+        Test caching of users directory sorted for dropdown.
+        """
+        directory = utils.get_users_directory()
+        self.assertEqual(
+            [user['user_id'] for user in directory.listing],
+            ['141', '176']
+        )
+        self.assertEqual(
+            directory.listing[0]['avatar'],
+            'https://intranet.stxnext.pl/api/images/users/141'
+        )
+        with patch('locale.setlocale') as setlocale:
+            self.assertIs(utils.get_users_directory(), directory)
+            self.assertEqual(utils.get_users_data()[0], directory.data)
+            self.assertFalse(setlocale.called)
+
+        with patch('locale.setlocale') as setlocale:
+            listing = utils.sort_users(
+                {
+                    '1': {'name': u'Zenon', 'avatar': '/1'},
+                    '2': {'name': u'adam', 'avatar': '/2'},
+                    '3': {'name': u'Adam', 'avatar': '/3'},
+                    '4': {'name': u'Łukasz', 'avatar': '/4'},
+                },
+                'http://host'
+            )
+            self.assertFalse(setlocale.called)
+        self.assertItemsEqual(
+            [(user['user_id'], user['avatar']) for user in listing],
+            [('1', 'http://host/1'), ('2', 'http://host/2'),
+             ('3', 'http://host/3'), ('4', 'http://host/4')]
+        )
+        self.assertEqual(listing[0]['name'], u'Adam')
+
+    def test_refresh_users_data(self):
+        """
+        Test conditional download of users data from HTTP server.
+        """
+        with open(TEST_USERS_DATA) as users_file:
+            content = users_file.read()
+        served = {'etag': '"v1"', 'last_modified': 1380000000}
+        requests = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            """
+            Local stand-in of users data server.
+            """
+
+            def do_GET(self):
+                requests.append(dict(self.headers))
+                if self.headers.get('If-None-Match') == served['etag']:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', served['etag'])
+                self.send_header('Last-Modified', formatdate(
+                    served['last_modified'], usegmt=True
+                ))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_POST(self):
+                requests.append(self.path)
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            url = 'http://127.0.0.1:%d/' % server.server_port
+            path = os.path.join(temp_dir, 'users.xml')
+            self.assertTrue(
+                refresh.refresh_users_data(url + 'users.xml', path,
+                                           url + 'notify')
+            )
+            with open(path) as users_file:
+                self.assertEqual(users_file.read(), content)
+            self.assertEqual(os.path.getmtime(path), 1380000000)
+            self.assertEqual(requests[-1], '/notify')
+
+            self.assertFalse(refresh.refresh_users_data(url, path))
+            self.assertEqual(requests[-1]['if-none-match'], '"v1"')
+            self.assertEqual(requests[-1]['if-modified-since'],
+                             'Tue, 24 Sep 2013 05:20:00 GMT')
+
+            served['etag'] = '"v2"'
+            self.assertFalse(refresh.download(url, path))
+            served['last_modified'] += 60
+            self.assertTrue(refresh.download(url, path))
+            self.assertItemsEqual(os.listdir(temp_dir),
+                                  ['users.xml', 'users.xml.etag'])
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            shutil.rmtree(temp_dir)
+
+    def test_background_refresher(self):
+        """
+        Test serving cached data while refreshing it in background.
+        """
+        temp_dir = tempfile.mkdtemp()
+        refresher = refresh.Refresher(0.01)
+        try:
+            temp_csv = os.path.join(temp_dir, 'data.csv')
+            shutil.copy(TEST_DATA_CSV, temp_csv)
+            main.app.config.update({'DATA_CSV': temp_csv})
+            self.assertTrue(refresher.refresh())
+            first = utils.get_dataset()
+            self.assertIsNotNone(first._team_weekdays)
+
+            with open(temp_csv, 'a') as csvfile:
+                csvfile.write('\n12,2013-09-16,09:00:00,17:00:00\n')
+            with patch.object(utils, 'load_dataset') as load_dataset:
+                self.assertIs(utils.get_dataset(), first)
+                self.assertFalse(load_dataset.called)
+
+            refresher.start()
+            for i in range(500):
+                if utils.get_dataset() is not first:
+                    break
+                time.sleep(0.01)
+            self.assertIn(12, utils.get_dataset())
+        finally:
+            refresher.stop()
+            refresher.join()
+            shutil.rmtree(temp_dir)
+        self.assertFalse(utils.get_dataset.cache.background)
+
+        with patch.object(refresh, 'refresh_data', side_effect=IOError):
+            self.assertFalse(refresh.Refresher(1).refresh())
+
+    def test_prefork_server(self):
+        """
+        Test recycling and reloading of pre-forked workers.
+        """
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [str(os.getpid())]
+
+        def load():
+            with open(loads_path, 'a') as loads:
+                loads.write('load\n')
+
+        temp_dir = tempfile.mkdtemp()
+        version_path = os.path.join(temp_dir, 'version')
+        loads_path = os.path.join(temp_dir, 'loads')
+        open(version_path, 'w').close()
+        server = prefork.PreforkServer(
+            application, ('127.0.0.1', 0), workers=1, max_requests=2,
+            check_interval=0.05, load=load,
+            version=lambda: file_identity(version_path),
+        )
+        host, port = server.bind()
+        url = 'http://%s:%d/' % (host, port)
+        master = os.fork()
+        if not master:
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        server.listener.close()
+        try:
+            pids = [urllib2.urlopen(url).read() for i in range(3)]
+            self.assertEqual(pids[0], pids[1])
+            self.assertNotEqual(pids[1], pids[2])
+
+            os.unlink(version_path)
+            for i in range(500):
+                with open(loads_path) as loads:
+                    if len(loads.readlines()) == 2:
+                        break
+                time.sleep(0.01)
+            else:
+                self.fail('data was not reloaded')
+            # old worker may still get a request before it is stopped
+            pid = urllib2.urlopen(url).read()
+            if pid in pids:
+                pid = urllib2.urlopen(url).read()
+            self.assertNotIn(pid, pids)
+        finally:
+            os.kill(master, signal.SIGTERM)
+            os.waitpid(master, 0)
+            shutil.rmtree(temp_dir)
+
+    def test_benchmark(self):
+        """
+        Test benchmark report and comparison with baseline.
+        """
+        config = dict(main.app.config)
+        report = benchmark.run(sizes=[40], repeat=1)
+        self.assertEqual(main.app.config, config)
+        names = [result['name'] for result in report['results']]
+        self.assertIn('get_data', names)
+        self.assertIn('view /api/v1/presence_weekday/<user_id>', names)
+        self.assertIn('team build_histograms', names)
+        self.assertEqual(
+            len(names),
+            6 + len(benchmark.VIEWS),
+        )
+
+        baseline = json.loads(json.dumps(report))
+        for result in baseline['results']:
+            result['best'] = result['best'] / 2 if result['name'] == (
+                'get_data') else result['best'] * 2
+        comparison = benchmark.compare(report, baseline, tolerance=0.2)
+        self.assertEqual(len(comparison), len(names))
+        regressed = [row[0] for row in comparison if row[-1]]
+        self.assertEqual(regressed, ['get_data'])
+
+    def test_generator(self):
+        """
+        Test generated presence and users data.
+        """
+        output = StringIO()
+        lines = generator.generate_presence(
+            output, 5, years=0.25, absence=0, malformed=0.1, seed=1,
+        )
+        other = StringIO()
+        generator.generate_presence(
+            other, 5, years=0.25, absence=0, malformed=0.1, seed=1,
+        )
+        self.assertEqual(output.getvalue(), other.getvalue())
+        self.assertEqual(len(output.getvalue().splitlines()), lines)
+
+        output.seek(0)
+        entries = list(parsers.parse_fast(output))
+        self.assertLess(len(entries), lines)
+        self.assertGreater(len(entries), lines * 0.8)
+        for user_id, day, start, end in entries:
+            self.assertIn(user_id, range(1, 6))
+            self.assertLess(datetime.date.fromordinal(day).weekday(), 5)
+            self.assertNotEqual(
+                datetime.date.fromordinal(day).strftime('%m-%d'), '01-06',
+            )
+            self.assertLess(start, end)
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            xml_path = os.path.join(temp_dir, 'users.xml')
+            generator.write_users_xml(xml_path, 5)
+            data, avatar_base_url = utils.read_users_data(xml_path)
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertItemsEqual(data.keys(), ['1', '2', '3', '4', '5'])
+        self.assertEqual(avatar_base_url, 'https://intranet.example.com')
+
+    def test_parallel_ingestion(self):
+        """
+        Test parsing CSV file in byte ranges by a pool of processes.
+        """
+        temp_dir = tempfile.mkdtemp()
+        try:
+            temp_csv = os.path.join(temp_dir, 'data.csv')
+            with open(temp_csv, 'w') as csvfile:
+                generator.generate_presence(
+                    csvfile, 7, years=0.5, malformed=0.05, seed=2,
+                )
+                # rows overriding earlier days of users
+                csvfile.write('3,2011-01-03,06:00:00,07:00:00\n'
+                              '5,2011-02-01,12:00:00,13:00:00')
+
+            ranges = ingest.byte_ranges(temp_csv, 9)
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], os.path.getsize(temp_csv))
+            with open(temp_csv) as csvfile:
+                content = csvfile.read()
+            pairs = zip(ranges, ranges[1:])
+            for (start, end), (next_start, next_end) in pairs:
+                self.assertEqual(end, next_start)
+                self.assertEqual(content[end - 1], '\n')
+            self.assertEqual(ingest.byte_ranges(temp_csv, 1),
+                             [(0, len(content))])
+
+            # files smaller than the number of parts
+            tiny_csv = os.path.join(temp_dir, 'tiny.csv')
+            with open(tiny_csv, 'w') as csvfile:
+                csvfile.write('10,2013-09-10,09:39:05,17:59:52\n')
+            self.assertEqual(ingest.byte_ranges(tiny_csv, 64), [(0, 32)])
+            with open(tiny_csv, 'w') as csvfile:
+                csvfile.write('1\n2\n')
+            self.assertEqual(ingest.byte_ranges(tiny_csv, 8),
+                             [(0, 2), (2, 4)])
+            users = ingest.parse_parallel(tiny_csv, 'fast', 2, parts=8)
+            self.assertEqual(users, {})
+
+            for engine in parsers.PARSE_ENGINES:
+                with open(temp_csv) as csvfile:
+                    expected = dataset.Dataset.from_entries(
+                        parsers.PARSE_ENGINES[engine](csvfile)
+                    )
+                users = ingest.parse_parallel(temp_csv, engine, 2, parts=9)
+                self.assertEqual(sorted(users), sorted(expected.users))
+                for user_id, presence in users.iteritems():
+                    other = expected.users[user_id]
+                    self.assertEqual(presence.days, other.days)
+                    self.assertEqual(presence.starts, other.starts)
+                    self.assertEqual(presence.ends, other.ends)
+            self.assertEqual(
+                users[3].starts[users[3].find(
+                    datetime.date(2011, 1, 3).toordinal()
+                )],
+                6 * 3600,
+            )
+
+            main.app.config.update({
+                'DATA_CSV': temp_csv,
+                'DATA_WORKERS': 2,
+                'DATA_PARALLEL_MIN_BYTES': 0,
+            })
+            with patch.object(utils, 'parse_parallel',
+                              wraps=ingest.parse_parallel) as parallel:
+                loaded = utils.get_dataset()
+            self.assertTrue(parallel.called)
+            self.assertEqual(weekday_sums(loaded.weekdays[5]),
+                             weekday_sums(expected.weekdays[5]))
+        finally:
+            main.app.config.update({'DATA_WORKERS': 1})
+            shutil.rmtree(temp_dir)
+
+    def test_invalidate_users(self):
+        """
+        Test dropping cached users directory on request of local client.
+        """
+        client = main.app.test_client()
+        directory = utils.get_users_directory()
+        resp = client.post('/api/v1/users/invalidate',
+                           environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEqual(resp.status_code, 403)
+        self.assertIs(utils.get_users_directory(), directory)
+        resp = client.post('/api/v1/users/invalidate')
+        self.assertEqual(resp.status_code, 204)
+        self.assertIsNot(utils.get_users_directory(), directory)
+
     def test_group_by_weekday(self):
         """
         Test grouping presence entries by weekday.
@@ -294,6 +1533,7 @@ def suite():
     """
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerSqliteViewsTestCase))
     suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
     return suite
 
@@ -3,32 +3,300 @@
 Helper functions used in views.
 """
 
-import csv
+import os
+import locale
 from lxml import etree
 from json import dumps
-from functools import wraps
-from datetime import datetime, time
+from functools import partial, wraps
+from collections import namedtuple
+from time import mktime
+from gzip import GzipFile
+from StringIO import StringIO
+from hashlib import sha1
+from datetime import date, datetime, time
 
-from flask import Response
+from flask import Response, request
 
 from presence_analyzer.main import app
+from presence_analyzer.cache import (
+    cached_by_file,
+    FileCache,
+    ResponseCache,
+)
+from presence_analyzer.dataset import Dataset
+from presence_analyzer.ingest import parse_parallel
+from presence_analyzer.repository import (
+    DatasetRepository,
+    SqliteRepository,
+    import_sqlite,
+)
+from presence_analyzer.metrics import phase
+from presence_analyzer.snapshot import open_snapshot
+from presence_analyzer.parsers import (
+    PARSE_ENGINES,
+    read_appended,
+    read_source,
+)
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
+# serialized JSON bodies with their data versions, see `jsonify`
+RESPONSE_CACHE = ResponseCache()
 
-def jsonify(function):
+
+def jsonify(function=None, version=None):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Response is tagged with ETag and Last-Modified of current version of
+    data behind the view, given by `version` function, `data_version` by
+    default. Conditional requests for that version are answered with 304
+    without calling wrapped function. Bodies are kept in RESPONSE_CACHE
+    for the current version of their data, up to RESPONSE_CACHE_BYTES config
+    option in total, along with their gzip variants for clients that
+    accept them.
     """
+    if function is None:
+        return partial(jsonify, version=version)
+    version_of = version or data_version
+
     @wraps(function)
     def inner(*args, **kwargs):
-        return Response(dumps(function(*args, **kwargs)),
-                        mimetype='application/json')
+        version = version_of()
+        compress = accepts_gzip()
+        etag = sha1(repr((version, compress))).hexdigest()
+        last_modified = datetime.utcfromtimestamp(int(max(
+            [mktime(item.timetuple()) if isinstance(item, date) else item[0]
+             for item in version if item] or [0]
+        )))
+        if is_not_modified(etag, last_modified):
+            response = Response(status=304)
+        else:
+            key = (request.path, request.query_string)
+            body = cached_body(
+                key, version, lambda: serialize(function(*args, **kwargs))
+            )
+            response = Response(body, mimetype='application/json')
+            if compress and len(body) >= app.config.get('GZIP_MIN_BYTES',
+                                                        512):
+                response.set_data(cached_body(
+                    key + ('gzip', ), version, lambda: gzip_bytes(body)
+                ))
+                response.content_encoding = 'gzip'
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        response.vary.add('Accept-Encoding')
+        return response
     return inner
 
 
+def serialize(result):
+    """
+    Dumps view result to JSON.
+    """
+    with phase('serialize'):
+        return dumps(result)
+
+
+def cached_body(key, version, build):
+    """
+    Returns body from RESPONSE_CACHE, building and storing it if missing.
+    """
+    body = RESPONSE_CACHE.get(key, version)
+    if body is None:
+        body = build()
+        RESPONSE_CACHE.put(
+            key, version, body,
+            app.config.get('RESPONSE_CACHE_BYTES', 16 * 1024 * 1024),
+        )
+    return body
+
+
+def accepts_gzip():
+    """
+    Checks if client of current request accepts gzip encoded responses.
+    """
+    return request.accept_encodings['gzip'] > 0
+
+
+def gzip_bytes(data):
+    """
+    Compresses data to gzip format.
+
+    Modification time is left out of the header, so output depends on
+    data only.
+    """
+    buf = StringIO()
+    with GzipFile(fileobj=buf, mode='wb', mtime=0) as gzip_file:
+        gzip_file.write(data)
+    return buf.getvalue()
+
+
+def gzip_file(path):
+    """
+    Returns gzip compressed content of file.
+    """
+    with open(path, 'rb') as source:
+        return gzip_bytes(source.read())
+
+
+# compressed static files, each kept until the file changes
+GZIPPED_FILES = FileCache(gzip_file)
+
+
+def is_not_modified(etag, last_modified):
+    """
+    Checks conditional headers of current request against given validators.
+    """
+    if request.if_none_match:
+        return etag in request.if_none_match
+    if last_modified is not None and request.if_modified_since:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def data_version():
+    """
+    Returns version of presence data behind chart responses.
+
+    It is made of current date, as start and end times are rendered on
+    it, and identity of presence data of current repository. Data is
+    loaded first, so the version never runs ahead of it.
+    """
+    return (date.today(), get_repository().version)
+
+
+def users_version():
+    """
+    Returns version of users directory behind users listing.
+
+    Users file is loaded first, so the version never runs ahead of it.
+    """
+    get_users_directory()
+    return (get_users_directory.cache.version(app.config['DATA_PATH']), )
+
+
+def update_dataset(path, dataset):
+    """
+    Adds rows appended to CSV file since given dataset was loaded.
+
+    Returns None when the file was rewritten and needs a full reload.
+    """
+    if dataset.source is None:
+        return None
+    with phase('load'):
+        with open(path, 'r') as csvfile:
+            appended = read_appended(csvfile, dataset.source)
+        if appended is None:
+            log.debug('File %s was rewritten', path)
+            return None
+        lines, source = appended
+        log.debug('Reading %d lines appended to %s', len(lines), path)
+        with phase('parse'):
+            return dataset.extended(parse_engine()(lines), source)
+
+
+@cached_by_file('DATA_CSV', updater=update_dataset)
+def get_dataset(path):
+    """
+    Loads presence data with its weekday aggregates.
+
+    Result is cached until the file changes, see `get_dataset.cache`.
+    Rows appended to the file since are parsed on their own and merged
+    into the cached dataset, see `update_dataset`.
+
+    When DATA_SNAPSHOT config option names a snapshot compiled from
+    the file, it is memory-mapped instead of parsing the whole file.
+    """
+    snapshot_path = app.config.get('DATA_SNAPSHOT')
+    if snapshot_path:
+        with phase('load'):
+            dataset = open_snapshot(snapshot_path)
+        if dataset is not None:
+            dataset = update_dataset(path, dataset)
+        if dataset is not None:
+            return dataset
+        log.info('Snapshot %s not used for %s', snapshot_path, path)
+    return load_dataset(path)
+
+
+def load_dataset(path):
+    """
+    Parses whole CSV file into dataset.
+
+    Files of DATA_PARALLEL_MIN_BYTES or more are parsed by DATA_WORKERS
+    processes when that option is above one, see `ingest`.
+    """
+    workers = app.config.get('DATA_WORKERS', 1)
+    with phase('load'):
+        with open(path, 'r') as csvfile:
+            source = read_source(csvfile)
+            csvfile.seek(0)
+            with phase('parse'):
+                if workers > 1 and os.fstat(csvfile.fileno()).st_size >= (
+                        app.config.get('DATA_PARALLEL_MIN_BYTES',
+                                       64 * 1024 * 1024)):
+                    return Dataset(parse_parallel(
+                        path,
+                        app.config.get('DATA_PARSER', 'csv'),
+                        workers,
+                    ), source=source)
+                return Dataset.from_entries(parse_engine()(csvfile), source)
+
+
+def get_repository():
+    """
+    Returns repository of presence data backend named in DATA_BACKEND.
+
+    "memory" (default) serves dataset loaded from DATA_CSV, "sqlite"
+    queries DATA_SQLITE database made by `repository.import_sqlite`.
+    """
+    if app.config.get('DATA_BACKEND', 'memory') == 'sqlite':
+        return get_sqlite_repository()
+    return DatasetRepository(
+        get_dataset(),
+        get_dataset.cache.version(app.config['DATA_CSV']),
+    )
+
+
+@cached_by_file('DATA_SQLITE')
+def get_sqlite_repository(path):
+    """
+    Opens SQLite repository, a new one each time the database changes.
+    """
+    return SqliteRepository(path)
+
+
+def import_sqlite_data(csv_path, sqlite_path):
+    """
+    Imports presence CSV file into SQLite database.
+    """
+    with open(csv_path, 'r') as csvfile:
+        return import_sqlite(parse_engine()(csvfile), sqlite_path)
+
+
 def get_data():
+    """
+    Returns presence data of current dataset version, see `read_data`.
+
+    Entries are served from the dataset's columnar store through
+    read-only mappings, so the dict layout is never built in full.
+    """
+    return get_dataset().data
+
+
+def parse_engine():
+    """
+    Returns parse engine named in DATA_PARSER config option.
+
+    See `parsers.PARSE_ENGINES`.
+    """
+    return PARSE_ENGINES[app.config.get('DATA_PARSER', 'csv')]
+
+
+def read_data(path):
     """
     Extracts presence data from CSV file and groups it by user_id.
 
@@ -46,29 +314,58 @@ def get_data():
         }
     }
     """
+    parse = parse_engine()
+    dates = {}
+    times = {}
     data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
-
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
-            else:
-                data.setdefault(user_id, {})[date] = {'start': start,
-                                                      'end': end}
+    with open(path, 'r') as csvfile:
+        for user_id, day, start, end in parse(csvfile):
+            if day not in dates:
+                dates[day] = date.fromordinal(day)
+            for seconds in (start, end):
+                if seconds not in times:
+                    times[seconds] = time_from_seconds(seconds)
+            data.setdefault(user_id, {})[dates[day]] = {
+                'start': times[start],
+                'end': times[end],
+            }
 
     return data
 
 
+# Users directory with listing for dropdown sorted by name.
+UsersDirectory = namedtuple(
+    'UsersDirectory',
+    ['data', 'avatar_base_url', 'listing'],
+)
+
+
+@cached_by_file('DATA_PATH')
+def get_users_directory(path):
+    """
+    Loads users directory from xml file.
+
+    Result is cached until the file changes, so the file is parsed and
+    users are collated once per version of the file.
+    """
+    with phase('load'):
+        data, avatar_base_url = read_users_data(path)
+        return UsersDirectory(
+            data,
+            avatar_base_url,
+            sort_users(data, avatar_base_url),
+        )
+
+
 def get_users_data():
+    """
+    Returns users data of current users directory, see `read_users_data`.
+    """
+    directory = get_users_directory()
+    return directory.data, directory.avatar_base_url
+
+
+def read_users_data(path):
     """
     Extracts users data from xml file
 
@@ -83,7 +380,7 @@ def get_users_data():
     user_data = {}
     avatar_base_url = None
     try:
-        tree = etree.parse(app.config['DATA_PATH'])
+        tree = etree.parse(path)
     except IOError:
         log.debug('Problem with parse xml file', exc_info=True)
     else:
@@ -100,21 +397,49 @@ def get_users_data():
     return user_data, avatar_base_url
 
 
+def sort_users(data, avatar_base_url):
+    """
+    Returns users listing for dropdown sorted by name in user's locale.
+
+    Names are collated by LC_COLLATE category, which is set once when
+    the app starts, see `script.make_app`.
+    """
+    user_ids = sorted(
+        data,
+        key=lambda user_id: collation_key(data[user_id]['name']),
+    )
+    return [
+        dict(
+            user_id=user_id,
+            name=data[user_id]['name'],
+            avatar='%s%s' % (
+                avatar_base_url,
+                data[user_id]['avatar']
+            ),
+        )
+        for user_id in user_ids
+    ]
+
+
+def collation_key(name):
+    """
+    Returns key sorting names in order of current LC_COLLATE locale.
+    """
+    encoding = locale.getlocale(locale.LC_COLLATE)[1] or 'utf-8'
+    if isinstance(name, unicode):
+        name = name.encode(encoding, 'replace')
+    return locale.strxfrm(name)
+
+
 def get_weekday_start_end(items):
     """
     Get start time and end time by weekdays
     """
     result = {}
-    for date in items:
-        week_day = date.weekday()
-        if not week_day in result.keys():
-            result[week_day] = {'start': [], 'end': []}
-        result[week_day]['start'].append(
-            seconds_since_midnight(items[date]['start'])
-        )
-        result[week_day]['end'].append(
-            seconds_since_midnight(items[date]['end'])
-        )
+    for day in items:
+        week_day = result.setdefault(day.weekday(), {'start': [], 'end': []})
+        week_day['start'].append(seconds_since_midnight(items[day]['start']))
+        week_day['end'].append(seconds_since_midnight(items[day]['end']))
 
     result = {key: {'start': int(mean(item['start'])),
                     'end': int(mean(item['end']))}
@@ -127,10 +452,10 @@ def group_by_weekday(items):
     Groups presence entries by weekday.
     """
     result = {i: [] for i in range(7)}
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()].append(interval(start, end))
+    for day in items:
+        start = items[day]['start']
+        end = items[day]['end']
+        result[day.weekday()].append(interval(start, end))
     return result
 
 
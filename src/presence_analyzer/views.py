@@ -4,26 +4,105 @@ Defines views.
 """
 
 import calendar
+from json import dumps
 from flask import (
+    abort,
+    Response,
     redirect,
-    render_template
+    render_template,
+    request
     )
 from datetime import datetime, date
+from werkzeug.security import safe_join
 from presence_analyzer.main import app
+from presence_analyzer.dataset import (
+    BIN_SECONDS,
+    HISTOGRAM_KINDS,
+    weekday_means,
+    weekday_start_end,
+    weekday_statistics,
+    weekday_totals,
+)
+from presence_analyzer import metrics, profiling
+from presence_analyzer.parsers import format_seconds
 from presence_analyzer.utils import (
+    GZIPPED_FILES,
+    RESPONSE_CACHE,
+    accepts_gzip,
     jsonify,
-    get_data,
-    get_users_data,
-    mean,
-    group_by_weekday,
-    get_weekday_start_end,
-    time_from_seconds
+    get_dataset,
+    get_repository,
+    get_users_directory,
+    time_from_seconds,
+    users_version,
 )
-import locale
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
 
+@app.before_request
+def start_timing():
+    """
+    Starts timing request when METRICS config option is set.
+    """
+    metrics.start_request()
+
+
+@app.teardown_request
+def finish_timing(exception=None):
+    """
+    Records timings of finished request, see `metrics_view`.
+    """
+    metrics.finish_request(request.endpoint)
+
+
+@app.before_request
+def start_profiling():
+    """
+    Profiles request when asked to, see `profiling.should_profile`.
+    """
+    profiling.start_request()
+
+
+@app.after_request
+def finish_profiling(response):
+    """
+    Stores profile of profiled request.
+    """
+    return profiling.finish_request(response)
+
+
+@app.teardown_request
+def abandon_profiling(exception=None):
+    """
+    Stops profiling of request that failed.
+    """
+    profiling.abandon_request()
+
+
+@app.after_request
+def compress_static(response):
+    """
+    Serves text static files gzip compressed to clients accepting it.
+
+    Compressed content is cached until the file changes.
+    """
+    if (request.endpoint != 'static' or response.status_code != 200 or
+            not accepts_gzip() or
+            response.mimetype not in COMPRESSED_MIMETYPES):
+        return response
+    path = safe_join(app.static_folder, request.view_args['filename'])
+    response.direct_passthrough = False
+    response.set_data(GZIPPED_FILES.get(path))
+    response.content_encoding = 'gzip'
+    response.vary.add('Accept-Encoding')
+    etag = response.get_etag()[0]
+    if etag:
+        # same content in another encoding, so the tag can only be weak
+        response.set_etag(etag, weak=True)
+    return response
+
+
 @app.route('/')
 def mainpage():
     """
@@ -49,30 +128,135 @@ def start_end_page():
 
 
 @app.route('/api/v1/users', methods=['GET'])
-@jsonify
+@jsonify(version=users_version)
 def users_view():
     """
     Users listing for dropdown.
     """
-    data, avatar_base_url = get_users_data()
-    sort_users = data.keys()
-    locale.setlocale(locale.LC_ALL, "")
-    sort_users.sort(
-        key=lambda user_id: data[user_id]['name'],
-        cmp=locale.strcoll
+    return get_users_directory().listing
+
+
+@app.route('/api/v1/users/invalidate', methods=['POST'])
+def invalidate_users_view():
+    """
+    Drops cached users directory after users data was refreshed.
+
+    Allowed only for clients listed in ADMIN_ADDRESSES config option.
+    """
+    if request.remote_addr not in app.config.get('ADMIN_ADDRESSES',
+                                                 ('127.0.0.1', '::1')):
+        abort(403)
+    get_users_directory.cache.invalidate()
+    return Response(status=204)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Request and phase timings with data and cache state for Prometheus.
+
+    Available when METRICS config option is set.
+    """
+    if not metrics.enabled():
+        abort(404)
+    return Response(
+        metrics.render(metrics_gauges()),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
     )
-    locale.setlocale(locale.LC_ALL, "C")
-    return [
-        dict(
-            user_id=user_id,
-            name=data[user_id]['name'],
-            avatar='%s%s' % (
-                avatar_base_url,
-                data[user_id]['avatar']
-            ),
-        )
-        for user_id in sort_users
+
+
+def metrics_gauges():
+    """
+    Returns state of loaded data and caches in `metrics.render` format.
+
+    Data is not loaded for a scrape, only what is cached is reported.
+    """
+    dataset = get_dataset.cache.peek(app.config['DATA_CSV'])
+    directory = get_users_directory.cache.peek(app.config['DATA_PATH'])
+    gauges = [
+        ('presence_dataset_rows', 'gauge',
+         'Presence entries in loaded dataset.',
+         [([], sum(len(presence) for presence in dataset.users.itervalues())
+           if dataset is not None else 0)]),
+        ('presence_dataset_users', 'gauge',
+         'Users with presence entries in loaded dataset.',
+         [([], len(dataset.users) if dataset is not None else 0)]),
+        ('presence_directory_users', 'gauge',
+         'Users in loaded users directory.',
+         [([], len(directory.data) if directory is not None else 0)]),
+        ('presence_file_cache_events_total', 'counter',
+         'Lookups of data files cache by result.',
+         [([('cache', name), ('event', event)], count)
+          for name, cache in (('dataset', get_dataset.cache),
+                              ('users', get_users_directory.cache))
+          for event, count in sorted(cache.stats.items())]),
+        ('presence_response_cache_events_total', 'counter',
+         'Lookups of JSON responses cache by result.',
+         [([('event', event)], count)
+          for event, count in sorted(RESPONSE_CACHE.stats.items())]),
+        ('presence_response_cache_bytes', 'gauge',
+         'Size of cached JSON responses.',
+         [([], RESPONSE_CACHE.size)]),
+        ('presence_response_cache_entries', 'gauge',
+         'Number of cached JSON responses.',
+         [([], len(RESPONSE_CACHE.entries))]),
     ]
+    return gauges
+
+
+@app.route('/api/v1/profiles', methods=['GET'])
+def profiles_view():
+    """
+    Lists stored request profiles, latest first.
+
+    Available to clients listed in PROFILING_ADDRESSES config option
+    when PROFILING is set.
+    """
+    check_profiling_access()
+    return Response(
+        dumps([
+            {
+                'id': record.id,
+                'path': record.path,
+                'created': record.created.isoformat(),
+                'seconds': record.seconds,
+            }
+            for record in profiling.PROFILES.list()
+        ]),
+        mimetype='application/json',
+    )
+
+
+@app.route('/api/v1/profiles/<int:profile_id>', methods=['GET'])
+def profile_view(profile_id):
+    """
+    Returns stored request profile.
+
+    Text report of top functions by default, `format=pstats` gives file
+    for `pstats.Stats` and other profile viewers.
+    """
+    check_profiling_access()
+    record = profiling.PROFILES.get(profile_id)
+    if record is None:
+        abort(404)
+    if request.args.get('format') == 'pstats':
+        response = Response(profiling.dump(record),
+                            mimetype='application/octet-stream')
+        response.headers['Content-Disposition'] = (
+            'attachment; filename=profile-%d.pstats' % record.id
+        )
+        return response
+    return Response(profiling.report(record), mimetype='text/plain')
+
+
+def check_profiling_access():
+    """
+    Aborts request unless profiling is on and the client is allowed.
+    """
+    if not profiling.enabled():
+        abort(404)
+    if not profiling.client_allowed():
+        abort(403)
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
@@ -81,16 +265,8 @@ def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        return []
-
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], mean(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    return result
+    return user_chart(mean_time_weekday, get_repository(), user_id,
+                      requested_period())
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
@@ -99,17 +275,8 @@ def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        return []
-
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], sum(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return user_chart(presence_weekday, get_repository(), user_id,
+                      requested_period())
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
@@ -118,12 +285,226 @@ def presence_start_end(user_id):
     """
     Returns mean start and end time by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    return user_chart(mean_start_end, get_repository(), user_id,
+                      requested_period())
+
+
+@app.route('/api/v1/presence_stats/<int:user_id>', methods=['GET'])
+@jsonify
+def presence_stats_view(user_id):
+    """
+    Returns median and 10th and 90th percentile of arrival, departure and
+    presence time of given user by weekday.
+    """
+    return user_statistics(presence_stats, get_repository(), user_id,
+                           requested_period())
+
+
+@app.route('/api/v1/presence_histogram/<int:user_id>', methods=['GET'])
+@jsonify
+def presence_histogram_view(user_id):
+    """
+    Returns histograms of arrival, departure and presence time of given
+    user by weekday.
+    """
+    return user_statistics(presence_histogram, get_repository(), user_id,
+                           requested_period())
+
+
+@app.route('/api/v1/batch/<chart>', methods=['GET'])
+@jsonify
+def batch_view(chart):
+    """
+    Returns chart data of many users at once, keyed by user_id.
+
+    Users are given as comma separated `users` query parameter,
+    `users=all` returns all users with presence data.
+    """
+    if chart in CHARTS:
+        build, chart = user_chart, CHARTS[chart]
+    elif chart in STATISTICS_CHARTS:
+        build, chart = user_statistics, STATISTICS_CHARTS[chart]
+    else:
+        abort(404)
+    period = requested_period()
+    repository = get_repository()
+    return {
+        user_id: build(chart, repository, user_id, period)
+        for user_id in requested_users(repository)
+    }
+
+
+@app.route('/api/v1/export', methods=['GET'])
+def export_view():
+    """
+    Streams cleaned presence data as CSV or NDJSON.
+
+    Accepts `format` (csv or ndjson, csv by default) and the `users`,
+    `from` and `to` parameters of batch view, all users by default.
+    Rows are generated as the response is sent, one chunk at a time.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    period = requested_period() or (date.min.toordinal(),
+                                    date.max.toordinal())
+    repository = get_repository()
+    user_ids = requested_users(repository, default='all')
+    mimetype, format_row = EXPORT_FORMATS[export_format]
+    return Response(
+        export_rows(repository, user_ids, period, format_row),
+        mimetype=mimetype,
+    )
+
+
+def export_rows(repository, user_ids, period, format_row,
+                chunk_size=1000):
+    """
+    Generates chunks of formatted presence rows of given users.
+    """
+    dates = {}
+    chunk = []
+    for user_id in user_ids:
+        for day, start, end in repository.entries(user_id, *period):
+            if day not in dates:
+                dates[day] = date.fromordinal(day).isoformat()
+            chunk.append(format_row(
+                user_id,
+                dates[day],
+                format_seconds(start),
+                format_seconds(end),
+            ))
+            if len(chunk) >= chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def csv_row(user_id, day, start, end):
+    """
+    Formats presence entry as line of presence CSV file.
+    """
+    return '%d,%s,%s,%s\n' % (user_id, day, start, end)
+
+
+def ndjson_row(user_id, day, start, end):
+    """
+    Formats presence entry as line of newline delimited JSON.
+    """
+    return '{"user_id": %d, "date": "%s", "start": "%s", "end": "%s"}\n' % (
+        user_id, day, start, end
+    )
+
+
+# mimetype and row formatter of export formats
+EXPORT_FORMATS = {
+    'csv': ('text/csv', csv_row),
+    'ndjson': ('application/x-ndjson', ndjson_row),
+}
+
+
+@app.route('/api/v1/team/<chart>', methods=['GET'])
+@jsonify
+def team_view(chart):
+    """
+    Returns chart data computed over presence of all users together.
+    """
+    repository = get_repository()
+    if chart in CHARTS:
+        chart, source = CHARTS[chart], repository.team_weekdays
+    elif chart in STATISTICS_CHARTS:
+        chart, source = STATISTICS_CHARTS[chart], repository.team_histograms
+    else:
+        abort(404)
+    with metrics.phase('aggregate'):
+        return chart(source())
+
+
+def requested_users(repository, default=''):
+    """
+    Returns user ids from comma separated `users` parameter.
+
+    `users=all` gives all users with presence data.
+    """
+    users = request.args.get('users', default)
+    if users == 'all':
+        return repository.user_ids()
+    try:
+        return [int(user_id) for user_id in users.split(',')]
+    except ValueError:
+        abort(400)
+
+
+def requested_period():
+    """
+    Returns (first_day, last_day) ordinals from `from` and `to` parameters.
+
+    Both are optional YYYY-MM-DD dates and are included in the period.
+    Returns None when neither is given.
+    """
+    if not request.args.get('from') and not request.args.get('to'):
+        return None
+    try:
+        return tuple(
+            datetime.strptime(request.args[name], '%Y-%m-%d').toordinal()
+            if request.args.get(name) else default.toordinal()
+            for name, default in (('from', date.min), ('to', date.max))
+        )
+    except ValueError:
+        abort(400)
+
+
+def user_chart(chart, repository, user_id, period=None):
+    """
+    Builds chart from weekday aggregates of given user.
+
+    When `period` is given only entries from that period are taken.
+    """
+    if user_id not in repository:
+        log.debug('User %s not found!', user_id)
+        return []
+    with metrics.phase('aggregate'):
+        return chart(repository.weekdays(user_id, period))
+
+
+def user_statistics(chart, repository, user_id, period=None):
+    """
+    Builds chart from weekday histograms of given user, see `user_chart`.
+    """
+    if user_id not in repository:
         log.debug('User %s not found!', user_id)
         return []
+    with metrics.phase('aggregate'):
+        return chart(repository.histograms(user_id, period))
+
+
+def mean_time_weekday(weekdays):
+    """
+    Mean presence time grouped by weekday.
+    """
+    result = [(calendar.day_abbr[weekday], mean_time)
+              for weekday, mean_time in weekday_means(weekdays)]
+
+    return result
+
+
+def presence_weekday(weekdays):
+    """
+    Total presence time grouped by weekday.
+    """
+    result = [(calendar.day_abbr[weekday], total)
+              for weekday, total in weekday_totals(weekdays)]
+
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
 
-    mean_hours = get_weekday_start_end(data[user_id])
+def mean_start_end(weekdays):
+    """
+    Mean start and end time by weekday.
+    """
+    mean_hours = weekday_start_end(weekdays)
     today = date.today()
     result = []
     for day, item in mean_hours.iteritems():
@@ -137,3 +518,55 @@ def presence_start_end(user_id):
     result = [[calendar.day_abbr[item[0]], item[1], item[2]]
               for item in result]
     return result
+
+
+def presence_stats(histograms):
+    """
+    Median and 10th and 90th percentile in seconds by weekday.
+    """
+    statistics = weekday_statistics(histograms)
+    return [[calendar.day_abbr[day], statistics[day]]
+            for day in sorted(statistics)]
+
+
+def presence_histogram(histograms):
+    """
+    Counts of entries in BIN_SECONDS wide bins by weekday.
+    """
+    return {
+        'bin_seconds': BIN_SECONDS,
+        'weekdays': [
+            [calendar.day_abbr[day], {
+                kind: list(getattr(weekday_histograms, kind))
+                for kind in HISTOGRAM_KINDS
+            }]
+            for day, weekday_histograms in enumerate(histograms)
+            if weekday_histograms.count
+        ],
+    }
+
+
+# static files served gzip compressed, see `compress_static`
+COMPRESSED_MIMETYPES = frozenset([
+    'application/javascript',
+    'application/json',
+    'application/x-javascript',
+    'text/css',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+])
+
+
+# charts available in batch and team views
+CHARTS = {
+    'mean_time_weekday': mean_time_weekday,
+    'presence_weekday': presence_weekday,
+    'presence_start_end': mean_start_end,
+}
+
+# charts of weekday histograms available in batch and team views
+STATISTICS_CHARTS = {
+    'presence_stats': presence_stats,
+    'presence_histogram': presence_histogram,
+}